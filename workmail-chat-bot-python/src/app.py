@@ -1,27 +1,80 @@
+import json
 import logging
 import os
-import requests
+import time
+import destinations
+import digest
+import ratelimit
 import utils
+import webhook
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 MAX_CHAT_MESSAGE_LEN = 1024
 
-def construct_chat_message(message_id, from_address, subject):
+# ACTIVE_WORDS match anywhere in the text by default, or only as whole words when ACTIVE_WORDS_MATCH is WORD.
+# They are searched in the subject, and when ACTIVE_WORDS_IN_BODY is true, in the body of emails whose subject does not match
+active_words_whole = os.getenv('ACTIVE_WORDS_MATCH', 'SUBSTRING').upper() == 'WORD'
+active_words_in_body = os.getenv('ACTIVE_WORDS_IN_BODY', 'false').lower() == 'true'
+
+# Time kept in reserve to log and return after posting to the webhook
+WEBHOOK_SAFETY_MARGIN_MS = 500
+
+# The webhook client is shared by all invocations in this Lambda container, so that connections are reused
+webhook_client = webhook.WebhookClient(
+    max_attempts=int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 4)),
+    connect_timeout=float(os.getenv('WEBHOOK_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.getenv('WEBHOOK_READ_TIMEOUT', 5)),
+)
+
+# Destinations are loaded once per Lambda container, see get_destinations, and posted to concurrently
+destination_list = None
+fan_out = destinations.FanOut(webhook_client)
+
+# Optional rate limit: at most RATE_LIMIT_PER_SECOND posts per destination, with bursts of RATE_LIMIT_BURST. Messages
+# over the limit are queued and delivered in order as tokens become available. With RATE_LIMIT_TABLE and
+# DELIVERY_QUEUE_URL, buckets are shared through DynamoDB and delivery_handler consumes an SQS FIFO queue, otherwise
+# both are kept in memory and the queue is drained by later invocations in this Lambda container
+rate_limit_per_second = float(os.getenv('RATE_LIMIT_PER_SECOND', 0))
+rate_limiter = None
+delivery_queue = None
+if rate_limit_per_second > 0:
+    rate_limit_table = os.getenv('RATE_LIMIT_TABLE')
+    rate_limiter = ratelimit.RateLimiter(
+        ratelimit.DynamoDBTokenBucketStore(rate_limit_table) if rate_limit_table else ratelimit.LocalTokenBucketStore(),
+        rate_limit_per_second,
+        burst=float(os.getenv('RATE_LIMIT_BURST', 1)),
+    )
+    delivery_queue_url = os.getenv('DELIVERY_QUEUE_URL')
+    delivery_queue = ratelimit.SQSDeliveryQueue(delivery_queue_url) if delivery_queue_url else ratelimit.LocalDeliveryQueue()
+# Receives after which SQS moves a queued message to the dead-letter queue, the maxReceiveCount of the delivery queue
+delivery_max_receive_count = int(os.getenv('DELIVERY_MAX_RECEIVE_COUNT', 20))
+
+# Optional digest mode: alerts are queued and posted as one digest message per DIGEST_WINDOW_SECONDS. With
+# DIGEST_QUEUE_URL, alerts go to SQS and digest_handler posts the digests, otherwise they are coalesced in memory
+digest_window_seconds = float(os.getenv('DIGEST_WINDOW_SECONDS', 0))
+alert_queue = None
+if digest_window_seconds > 0:
+    digest_queue_url = os.getenv('DIGEST_QUEUE_URL')
+    alert_queue = digest.SQSAlertQueue(digest_queue_url) if digest_queue_url else digest.LocalAlertQueue(digest_window_seconds)
+
+def construct_chat_message(message_id, from_address, subject, email_body=None):
     """
     Constructs a chat message by downloading the full email message, parsing the email body, and truncating contents if required.
     Parameters
     ----------
     message_id: string, required
         message_id of the email to download
+    email_body: string, optional
+        the email body, when the email was already downloaded and parsed
     Returns
     -------
     string
         chat message
     """
-    parsed_email = utils.download_email(message_id)
-    email_body = utils.extract_email_body(parsed_email)
+    if email_body is None:
+        email_body = utils.extract_email_body(utils.download_email(message_id)) or ''
     if len(email_body) > MAX_CHAT_MESSAGE_LEN:
         email_body = email_body[:MAX_CHAT_MESSAGE_LEN]
         email_body = f"{email_body}\n\n....Content was truncated."
@@ -90,45 +143,186 @@ def chat_handler(event, context):
     Nothing
     """
     logger.info(event)
-    webhook_url = os.getenv('WEBHOOK_URL')
-    if not webhook_url:
-        error_msg = 'WEBHOOK_URL not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it.'
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-
-    chat_client = os.getenv('CHAT_CLIENT')
-    if not chat_client:
-        error_msg = 'CHAT_CLIENT not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it.'
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-
-    active_words = os.getenv('ACTIVE_WORDS')
     subject = event['subject']
     from_address = event['envelope']['mailFrom']['address']
 
-    if utils.search_active_words(subject, active_words):
-        headers = {'Content-Type': 'application/json'}
-        message_text = construct_chat_message(event['messageId'], from_address, subject)
-        payload = None
-        if chat_client == 'Chime':
-            payload = {'Content': message_text}
-        elif chat_client == 'Slack':
-            payload  = {'text': message_text}
-        # To add a new custom chat client, implement here:
-        # elif chat_client == 'CHAT_CLIENT_NAME'
-        #     payload = 'FOLLOW_CHAT_CLIENT_PAYLOAD_SYNTAX'
+    # route the alert by sender and active words. The subject decides first, the email is only downloaded to search
+    # its body for the destinations whose active words are not in the subject
+    targets = []
+    body_candidates = []
+    for destination in get_destinations():
+        if not destinations.accepts_sender(destination, from_address):
+            continue
+        if destination.matcher is None or destination.matcher.search(subject):
+            targets.append(destination)
+        elif active_words_in_body:
+            body_candidates.append(destination)
+    email_body = None
+    if body_candidates:
+        email_body = utils.extract_email_body(utils.download_email(event['messageId'])) or ''
+        targets += [destination for destination in body_candidates if destination.matcher.search_text(email_body)]
+
+    if targets:
+        message_text = construct_chat_message(event['messageId'], from_address, subject, email_body)
+        alert = {'from': from_address, 'subject': subject, 'text': message_text, 'time': time.time(),
+                 'destinations': [destination.name for destination in targets]}
+        if alert_queue:
+            alert_queue.put(alert)
+            alerts = alert_queue.take_due()
+            if alerts:
+                post_digests(alerts, context)
         else:
-            error_msg = f"Unsupported chat client: {chat_client}. Expected: Chime, Slack"
-            logger.error(error_msg)
-            raise NotImplementedError(error_msg)
-        try:
-            req = requests.post(webhook_url, headers=headers, json=payload)
-            req.raise_for_status()
-        except Exception:
-            error_msg = f"Error while posting message to WebHook: {webhook_url}"
-            logger.exception(error_msg)
-            raise ConnectionError(error_msg)
+            post_messages([(destination, message_text, alert) for destination in targets], context)
     else:
         logger.info(f"Skipping sending chat message from {from_address} as it did not match Active Words.")
 
     return
+
+def digest_handler(event, context):
+    """
+    Posts one digest message per destination for the alerts that chat_handler queued in SQS during a batching window
+
+    Parameters
+    ----------
+    event: dict, required
+        SQS event, every record holds an alert as JSON
+    context: object, required
+        Lambda Context runtime methods and attributes
+    Returns
+    ------
+    Nothing
+    """
+    alerts = [json.loads(record['body']) for record in event['Records']]
+    logger.info(f"Posting a digest of {len(alerts)} alerts")
+    post_digests(alerts, context)
+
+def get_destinations():
+    """
+    Returns the destinations, they are loaded and their active words compiled once per Lambda container
+    """
+    global destination_list
+    if destination_list is None:
+        destination_list = destinations.load_destinations(active_words_whole)
+    return destination_list
+
+def post_digests(alerts, context):
+    """
+    Posts a digest of the given alerts to each of their destinations
+    """
+    alerts_by_destination = {}
+    for alert in alerts:
+        for name in alert.get('destinations', ['default']):
+            alerts_by_destination.setdefault(name, []).append(alert)
+    posts = [(destination, digest.build_digest(alerts_by_destination[destination.name]),
+              digest.build_digest_alert(alerts_by_destination[destination.name]))
+             for destination in get_destinations() if destination.name in alerts_by_destination]
+    post_messages(posts, context)
+
+def post_messages(posts, context):
+    """
+    Posts chat messages to their destinations concurrently, within the remaining time of the invocation. Failures of
+    some destinations are logged, the invocation only fails when no destination could be posted to, as a retry would
+    post the message again to the destinations that succeeded. With a rate limit, messages over the limit of their
+    destination are queued instead.
+    """
+    if rate_limiter:
+        posts = drain_local_queue() + [post for post in posts if not queue_when_limited(*post)]
+        if not posts:
+            return
+    deadline = time.monotonic() + (context.get_remaining_time_in_millis() - WEBHOOK_SAFETY_MARGIN_MS) / 1000
+    failed = fan_out.post_all(posts, deadline)
+    if failed and len(failed) == len(posts):
+        error_msg = f"Error while posting message to destinations: {', '.join(failed)}"
+        logger.error(error_msg)
+        raise ConnectionError(error_msg)
+    if failed:
+        logger.error(f"Posted message to {len(posts) - len(failed)} of {len(posts)} destinations, failed: {', '.join(failed)}")
+
+def queue_when_limited(destination, message_text, alert):
+    """
+    Queues the message and returns True when the destination has no token left, or older messages wait in its queue
+    """
+    if rate_limiter.acquire(destination.name, destination.rate, require_empty_queue=True):
+        return False
+    logger.info(f"Rate limit of destination {destination.name} reached, queueing the message")
+    # SQS and DynamoDB writes cannot share a transaction: the message is counted before it is sent, so that it is
+    # never delivered uncounted, and a count left over by a failed send expires with the idle queue of the destination
+    rate_limiter.add_queued(destination.name, 1)
+    try:
+        delivery_queue.put(destination.name, {'destination': destination.name, 'text': message_text, 'alert': alert})
+    except Exception:
+        rate_limiter.add_queued(destination.name, -1)
+        raise
+    return True
+
+def drain_local_queue():
+    """
+    Returns the posts of the messages in the in-memory delivery queue that have a token now, oldest first
+    """
+    posts = []
+    for destination in get_destinations():
+        messages = delivery_queue.drain(destination.name, lambda: rate_limiter.acquire(destination.name, destination.rate))
+        if messages:
+            rate_limiter.add_queued(destination.name, -len(messages))
+            posts += [(destination, message['text'], message['alert']) for message in messages]
+    return posts
+
+def delivery_handler(event, context):
+    """
+    Delivers the messages that were queued in the SQS FIFO delivery queue because their destination was rate limited.
+    Messages are posted in order, waiting for tokens while the invocation has time. When a message cannot be posted,
+    it and the later messages of its destination are returned to the queue, to be redelivered in order. A message
+    returned on its last receive goes to the dead-letter queue, so it no longer counts as queued for its destination.
+
+    Parameters
+    ----------
+    event: dict, required
+        SQS event, every record holds a queued message as JSON
+    context: object, required
+        Lambda Context runtime methods and attributes
+    Returns
+    ------
+    dict
+        The records to redeliver, in the format of partial batch responses
+    """
+    destinations_by_name = {destination.name: destination for destination in get_destinations()}
+    deadline = time.monotonic() + (context.get_remaining_time_in_millis() - WEBHOOK_SAFETY_MARGIN_MS) / 1000
+    failed_groups = set()
+    failures = []
+
+    def redeliver(record, name):
+        if int(record['attributes']['ApproximateReceiveCount']) >= delivery_max_receive_count:
+            logger.error(f"Queued message {record['messageId']} for destination {name} was received "
+                         f"{delivery_max_receive_count} times, it is moved to the dead-letter queue")
+            rate_limiter.add_queued(name, -1)
+        failures.append({'itemIdentifier': record['messageId']})
+
+    for record in event['Records']:
+        message = json.loads(record['body'])
+        name = message['destination']
+        if name in failed_groups:
+            redeliver(record, name)
+            continue
+        destination = destinations_by_name.get(name)
+        if destination is None:
+            logger.error(f"Dropping message for unknown destination {name}")
+            rate_limiter.add_queued(name, -1)
+            continue
+
+        acquired = rate_limiter.acquire(name, destination.rate)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(min(1 / (destination.rate or rate_limiter.rate), max(deadline - time.monotonic(), 0)))
+            acquired = rate_limiter.acquire(name, destination.rate)
+        try:
+            if not acquired:
+                raise TimeoutError("No token before the end of the invocation")
+            payload = destinations.PAYLOAD_BUILDERS[destination.client](message['text'], message['alert'])
+            webhook_client.post(destination.url, payload, min(deadline, time.monotonic() + destination.timeout))
+            rate_limiter.add_queued(name, -1)
+        except Exception as e:
+            logger.error(f"Error while delivering queued message to destination {name}, it will be redelivered: {e}")
+            failed_groups.add(name)
+            # the messages of the destination are still waiting, keep their count from expiring
+            rate_limiter.mark_active(name)
+            redeliver(record, name)
+    return {'batchItemFailures': failures}
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+import utils
+
+logger = logging.getLogger()
+
+# Payload builders per chat client, called with the chat message and the alert it was built from
+PAYLOAD_BUILDERS = {
+    'Chime': lambda message_text, alert: {'Content': message_text},
+    'Slack': lambda message_text, alert: {'text': message_text},
+    'Webhook': lambda message_text, alert: {'from': alert.get('from'), 'subject': alert.get('subject'), 'text': message_text,
+                                            **({'alerts': alert['alerts']} if 'alerts' in alert else {})},
+    # To add a new custom chat client, add its payload builder here:
+    # 'CHAT_CLIENT_NAME': lambda message_text, alert: 'FOLLOW_CHAT_CLIENT_PAYLOAD_SYNTAX',
+}
+
+# Timeout of a post to a destination, unless the destination sets its own
+DEFAULT_TIMEOUT_SECONDS = 5
+
+Destination = namedtuple('Destination', ['name', 'client', 'url', 'matcher', 'senders', 'timeout', 'rate'])
+
+def load_destinations(whole_words=False):
+    """
+    Loads destinations from the DESTINATIONS environment variable, a JSON list such as:
+
+        [
+            { "name": "ops", "client": "Chime", "url": "https://hooks.chime.aws/...", "activeWords": "URGENT, outage" },
+            { "name": "alerts", "client": "Slack", "url": "https://hooks.slack.com/...", "senders": ["@monitoring.example.test"] },
+            { "name": "ticketing", "client": "Webhook", "url": "https://tickets.example.test/hook", "timeoutSeconds": 2 }
+        ]
+
+    "activeWords" and "senders" are routing rules: an alert is posted to a destination when its subject (or body,
+    with ACTIVE_WORDS_IN_BODY) contains any of its active words, and it is from any of its senders, given as addresses
+    or as "@domain". A destination without them receives every alert. "ratePerSecond" overrides RATE_LIMIT_PER_SECOND.
+
+    When DESTINATIONS is not set, the only destination is WEBHOOK_URL, of CHAT_CLIENT, with ACTIVE_WORDS
+
+    Returns
+    -------
+    list
+        A list of Destination
+    Raises
+    ------
+    ValueError:
+        When a destination is invalid, or neither DESTINATIONS nor WEBHOOK_URL and CHAT_CLIENT are set
+    NotImplementedError:
+        When the chat client of a destination is not supported
+    """
+    destinations_json = os.getenv('DESTINATIONS')
+    if destinations_json:
+        configs = json.loads(destinations_json)
+    else:
+        configs = [{
+            'name': 'default',
+            'client': utils.get_env_var('CHAT_CLIENT'),
+            'url': utils.get_env_var('WEBHOOK_URL'),
+            'activeWords': os.getenv('ACTIVE_WORDS'),
+        }]
+
+    destinations = []
+    for index, config in enumerate(configs):
+        if not config.get('url') or not config.get('client'):
+            raise ValueError(f"Invalid destination at index {index}, expected a client and a url")
+        if config['client'] not in PAYLOAD_BUILDERS:
+            error_msg = f"Unsupported chat client: {config['client']}. Expected: {', '.join(PAYLOAD_BUILDERS)}"
+            logger.error(error_msg)
+            raise NotImplementedError(error_msg)
+        destinations.append(Destination(
+            config.get('name', f"destination-{index}"),
+            config['client'],
+            config['url'],
+            utils.get_active_words_matcher(config.get('activeWords'), whole_words),
+            tuple(sender.lower() for sender in config.get('senders', [])),
+            float(config.get('timeoutSeconds', DEFAULT_TIMEOUT_SECONDS)),
+            float(config['ratePerSecond']) if config.get('ratePerSecond') else None,
+        ))
+    return destinations
+
+def accepts_sender(destination, from_address):
+    """
+    Returns True when the destination has no senders, or from_address is one of them or in one of their domains
+    """
+    if not destination.senders:
+        return True
+    address = from_address.lower()
+    return any(address == sender or (sender.startswith('@') and address.endswith(sender)) for sender in destination.senders)
+
+class FanOut:
+    """
+    Posts messages to several destinations concurrently, each within its own timeout and the deadline of the
+    invocation, so that the total latency is that of the slowest destination rather than the sum of all of them.
+    """
+
+    def __init__(self, webhook_client, max_workers=8):
+        self.webhook_client = webhook_client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def post_all(self, posts, deadline):
+        """
+        Posts to all destinations and returns the names of the destinations that failed
+
+        Parameters
+        ----------
+        posts: list, required
+            (Destination, message_text, alert) tuples
+        deadline: float, required
+            time.monotonic() by which all posts have to be done
+        Returns
+        -------
+        list
+            names of the destinations whose post failed or did not finish before deadline
+        """
+        futures = {}
+        for destination, message_text, alert in posts:
+            payload = PAYLOAD_BUILDERS[destination.client](message_text, alert)
+            destination_deadline = min(deadline, time.monotonic() + destination.timeout)
+            futures[self.executor.submit(self.webhook_client.post, destination.url, payload, destination_deadline)] = destination.name
+
+        done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        failed = [futures[future] for future in not_done]
+        for future in done:
+            if future.exception():
+                logger.error(f"Error while posting message to destination {futures[future]}: {future.exception()}")
+                failed.append(futures[future])
+        return failed
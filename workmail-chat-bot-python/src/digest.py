@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+import boto3
+
+# Number of senders and subjects listed in a digest, the others are summarized with a count
+DIGEST_TOP_ENTRIES = 10
+
+class LocalAlertQueue:
+    """
+    In-memory stand-in for SQSAlertQueue, alerts are only coalesced per Lambda container and a window is only flushed
+    by the next alert after it ends. This makes it useful for local testing and benchmarking.
+    """
+
+    def __init__(self, window_seconds, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self.alerts = []
+        self.window_start = None
+        self._lock = threading.Lock()
+
+    def put(self, alert):
+        with self._lock:
+            if not self.alerts:
+                self.window_start = self.clock()
+            self.alerts.append(alert)
+
+    def take_due(self):
+        """
+        Returns the buffered alerts and empties the buffer when the window has ended, otherwise an empty list
+        """
+        with self._lock:
+            if not self.alerts or self.clock() - self.window_start < self.window_seconds:
+                return []
+            alerts, self.alerts = self.alerts, []
+            return alerts
+
+class SQSAlertQueue:
+    """
+    Sends alerts to an SQS queue. The digest function is subscribed to the queue with a batching window, so Lambda
+    delivers the alerts of a window in one batch and take_due has nothing to do.
+    """
+
+    def __init__(self, queue_url, sqs_client=None):
+        self.queue_url = queue_url
+        self.client = sqs_client or boto3.client('sqs')
+
+    def put(self, alert):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(alert))
+
+    def take_due(self):
+        return []
+
+def build_digest(alerts):
+    """
+    Summarizes alerts into one chat message
+
+    Parameters
+    ----------
+    alerts: list, required
+        alerts as queued by chat_handler, dicts with "from", "subject", "text" and "time"
+    Returns
+    -------
+    string
+        The text of the only alert, or the number of alerts and their senders and subjects with counts
+    """
+    if len(alerts) == 1:
+        return alerts[0]['text']
+    first, last = (datetime.fromtimestamp(t, timezone.utc).strftime('%H:%M:%S') for t in
+                   (min(alert['time'] for alert in alerts), max(alert['time'] for alert in alerts)))
+    lines = [f"Digest: {len(alerts)} alerts between {first} and {last} UTC"]
+    lines.append("From: " + summarize(Counter(alert['from'] for alert in alerts), 'senders'))
+    lines.append("Subjects: " + summarize(Counter(alert['subject'] for alert in alerts), 'subjects'))
+    return '\n'.join(lines)
+
+def build_digest_alert(alerts):
+    """
+    Returns the alert a digest is posted with, for payload builders that use its fields
+
+    Parameters
+    ----------
+    alerts: list, required
+        alerts as queued by chat_handler
+    Returns
+    -------
+    dict
+        The only alert, or an alert with the most frequent senders as "from", the number of alerts as "subject", the
+        time of the latest alert and the "from", "subject" and "time" of every alert as "alerts"
+    """
+    if len(alerts) == 1:
+        return alerts[0]
+    senders = Counter(alert['from'] for alert in alerts)
+    return {
+        'from': ', '.join(sender for sender, _ in senders.most_common(DIGEST_TOP_ENTRIES)),
+        'subject': f"Digest of {len(alerts)} alerts",
+        'time': max(alert['time'] for alert in alerts),
+        'alerts': [{'from': alert['from'], 'subject': alert['subject'], 'time': alert['time']} for alert in alerts],
+    }
+
+def summarize(counter, noun):
+    entries = [f"{value} ({count})" for value, count in counter.most_common(DIGEST_TOP_ENTRIES)]
+    if len(counter) > DIGEST_TOP_ENTRIES:
+        others = counter.most_common()[DIGEST_TOP_ENTRIES:]
+        entries.append(f"and {sum(count for _, count in others)} alerts with {len(others)} other {noun}")
+    return ', '.join(entries)
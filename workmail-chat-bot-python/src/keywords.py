@@ -0,0 +1,72 @@
+import re
+
+# Bodies are searched in windows of this many characters, so that a match early in a long body is found without
+# casefolding the rest of it
+BODY_WINDOW_SIZE = 65536
+
+class KeywordMatcher:
+    """
+    Matches a list of words against text, compiled once into a single regex.
+
+    The words are arranged in a trie, which the regex engine walks like an automaton: at every position of the text
+    it only follows the branch of the next character, instead of trying every word. Words and text are casefolded,
+    so that the match is case-insensitive for all Unicode text, e.g. "STRASSE" matches "straße". With whole_words,
+    a word only matches when it is not preceded or followed by a letter, digit or underscore.
+    """
+
+    def __init__(self, words, whole_words=False):
+        self.words = sorted({word.strip().casefold() for word in words if word.strip()})
+        if not self.words:
+            raise ValueError("No words to match")
+        self.max_length = max(len(word) for word in self.words)
+        pattern = trie_pattern(self.words)
+        if whole_words:
+            pattern = rf"(?<!\w){pattern}(?!\w)"
+        self.regex = re.compile(pattern)
+
+    def search(self, text):
+        """
+        Returns True when any word occurs in text
+        """
+        return bool(text) and self.regex.search(text.casefold()) is not None
+
+    def search_text(self, text, window_size=BODY_WINDOW_SIZE):
+        """
+        Returns True when any word occurs in text, searching long text window by window and stopping at the first match
+        """
+        if not text:
+            return False
+        if len(text) <= window_size:
+            return self.search(text)
+        # every window starts one character early so that whole_words can look behind, and overlaps the next window by
+        # the longest word plus one character to look ahead. Matches starting in the overlap are left to the next window
+        for start in range(0, len(text), window_size):
+            before = text[start - 1].casefold() if start else ''
+            window = text[start:start + window_size].casefold()
+            overlap = text[start + window_size:start + window_size + self.max_length + 1].casefold()
+            match = self.regex.search(before + window + overlap, len(before))
+            if match and match.start() < len(before) + len(window):
+                return True
+        return False
+
+def trie_pattern(words):
+    """
+    Returns a regex pattern matching any of words, with common prefixes factored out, e.g. "ab(?:c|d)" for abc and abd
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _node_pattern(trie)
+
+def _node_pattern(node):
+    branches = [re.escape(char) + _node_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+    pattern = '(?:' + '|'.join(branches) + ')'
+    # a word ends at this node, so the longer words are optional
+    return pattern + '?' if '' in node else pattern
@@ -0,0 +1,203 @@
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from decimal import Decimal
+import boto3
+from botocore.exceptions import ClientError
+
+# Seconds after which a destination whose queued messages have not been sent or received is considered to have none
+# left. The delivery function receives a waiting message at least once per visibility timeout of the delivery queue
+# plus its own timeout, so a count without activity for longer is left over from a failure between the SQS and the
+# DynamoDB write of queueing a message, and is reset.
+QUEUE_IDLE_SECONDS = 300
+
+class LocalTokenBucketStore:
+    """
+    In-memory stand-in for DynamoDBTokenBucketStore, buckets are only shared by the invocations of one Lambda
+    container, which makes it useful for local testing and benchmarking.
+    """
+
+    def __init__(self, queue_idle_seconds=QUEUE_IDLE_SECONDS):
+        self.queue_idle_seconds = queue_idle_seconds
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name, rate, burst, now, require_empty_queue=False):
+        with self._lock:
+            tokens, updated, queued, active = self.buckets.get(name, (None, None, 0, None))
+            if queued > 0 and now - active >= self.queue_idle_seconds:
+                queued = 0
+            tokens = burst if updated is None else min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1 and not (require_empty_queue and queued > 0)
+            self.buckets[name] = (tokens - 1 if allowed else tokens, now, queued, active)
+            return allowed
+
+    def add_queued(self, name, count, now):
+        with self._lock:
+            tokens, updated, queued, _ = self.buckets.get(name, (None, None, 0, None))
+            self.buckets[name] = (tokens, updated, max(queued + count, 0), now)
+
+    def mark_active(self, name, now):
+        with self._lock:
+            tokens, updated, queued, _ = self.buckets.get(name, (None, None, 0, None))
+            self.buckets[name] = (tokens, updated, queued, now)
+
+class DynamoDBTokenBucketStore:
+    """
+    Keeps a token bucket per destination in a DynamoDB table keyed by Destination, shared by all Lambda containers.
+    Tokens are taken with optimistic concurrency: the refilled bucket is written on condition that nobody else updated
+    it since it was read. Queued counts the messages of the destination that wait in the delivery queue, while it is
+    not 0 new messages are queued behind them instead of being posted directly, which keeps messages in order.
+    ActiveAt is the last time a message of the destination was queued, delivered or received by the delivery function,
+    a Queued count without activity for queue_idle_seconds is stale and reset when the next token is taken.
+    """
+
+    def __init__(self, table_name, dynamodb=None, max_conflicts=5, queue_idle_seconds=QUEUE_IDLE_SECONDS):
+        self.table = (dynamodb or boto3.resource('dynamodb')).Table(table_name)
+        self.max_conflicts = max_conflicts
+        self.queue_idle_seconds = queue_idle_seconds
+
+    def acquire(self, name, rate, burst, now, require_empty_queue=False):
+        for _ in range(self.max_conflicts):
+            item = self.table.get_item(Key={'Destination': name}, ConsistentRead=True).get('Item', {})
+            queued = item.get('Queued', 0) > 0
+            stale = queued and now - float(item.get('ActiveAt', 0)) >= self.queue_idle_seconds
+            if require_empty_queue and queued and not stale:
+                return False
+            updated = float(item['UpdatedAt']) if 'UpdatedAt' in item else None
+            tokens = burst if updated is None else min(burst, float(item['Tokens']) + (now - updated) * rate)
+            if tokens < 1:
+                return False
+
+            condition = 'attribute_not_exists(UpdatedAt)' if updated is None else 'UpdatedAt = :updated'
+            update = 'SET Tokens = :tokens, UpdatedAt = :now'
+            values = {':tokens': Decimal(str(round(tokens - 1, 6))), ':now': Decimal(str(now))}
+            if updated is not None:
+                values[':updated'] = item['UpdatedAt']
+            if require_empty_queue and stale:
+                # reset the stale count, unless a message was queued or delivered since it was read
+                active = 'attribute_not_exists(ActiveAt)' if 'ActiveAt' not in item else 'ActiveAt = :active'
+                condition = f"({condition}) AND Queued = :queued AND {active}"
+                update += ', Queued = :zero'
+                values.update({':queued': item['Queued'], ':zero': 0})
+                if 'ActiveAt' in item:
+                    values[':active'] = item['ActiveAt']
+            elif require_empty_queue:
+                condition = f"({condition}) AND (attribute_not_exists(Queued) OR Queued <= :zero)"
+                values[':zero'] = 0
+            try:
+                self.table.update_item(
+                    Key={'Destination': name},
+                    UpdateExpression=update,
+                    ConditionExpression=condition,
+                    ExpressionAttributeValues=values,
+                )
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
+                # another invocation took a token or queued a message in the meantime, read the bucket again
+        return False
+
+    def add_queued(self, name, count, now):
+        try:
+            self.table.update_item(
+                Key={'Destination': name},
+                UpdateExpression='ADD Queued :count SET ActiveAt = :now',
+                # the count never goes below 0, e.g. when SQS delivered a message twice
+                ConditionExpression='attribute_not_exists(Queued) OR Queued >= :minimum',
+                ExpressionAttributeValues={':count': count, ':now': Decimal(str(now)), ':minimum': max(-count, 0)},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            self.table.update_item(
+                Key={'Destination': name},
+                UpdateExpression='SET Queued = :zero, ActiveAt = :now',
+                ExpressionAttributeValues={':zero': 0, ':now': Decimal(str(now))},
+            )
+
+    def mark_active(self, name, now):
+        self.table.update_item(
+            Key={'Destination': name},
+            UpdateExpression='SET ActiveAt = :now',
+            ExpressionAttributeValues={':now': Decimal(str(now))},
+        )
+
+class RateLimiter:
+    """
+    Limits the posts per destination with token buckets that hold up to burst tokens and refill at rate per second
+    """
+
+    def __init__(self, store, rate, burst=1, clock=time.time):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+    def acquire(self, name, rate=None, require_empty_queue=False):
+        """
+        Takes a token for the destination and returns True, or returns False when there is none. With
+        require_empty_queue, also returns False while messages of the destination wait in the delivery queue
+        """
+        return self.store.acquire(name, rate or self.rate, self.burst, self.clock(), require_empty_queue)
+
+    def add_queued(self, name, count):
+        """
+        Adds count, which may be negative, to the number of messages of the destination in the delivery queue
+        """
+        self.store.add_queued(name, count, self.clock())
+
+    def mark_active(self, name):
+        """
+        Records that a queued message of the destination was received, without being delivered
+        """
+        self.store.mark_active(name, self.clock())
+
+class LocalDeliveryQueue:
+    """
+    In-memory stand-in for SQSDeliveryQueue, queued messages are delivered in order by later invocations in the same
+    Lambda container, see drain
+    """
+
+    def __init__(self):
+        self.messages = {}
+        self._lock = threading.Lock()
+
+    def put(self, name, message):
+        with self._lock:
+            self.messages.setdefault(name, deque()).append(message)
+
+    def drain(self, name, acquire):
+        """
+        Removes and returns the oldest messages of the destination for which acquire() returns True
+        """
+        drained = []
+        with self._lock:
+            queue = self.messages.get(name)
+            while queue and acquire():
+                drained.append(queue.popleft())
+        return drained
+
+class SQSDeliveryQueue:
+    """
+    Sends messages to an SQS FIFO queue, grouped by destination so that SQS redelivers them in order. delivery_handler
+    consumes the queue and posts the messages as tokens become available.
+    """
+
+    def __init__(self, queue_url, sqs_client=None):
+        self.queue_url = queue_url
+        self.client = sqs_client or boto3.client('sqs')
+
+    def put(self, name, message):
+        self.client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(message),
+            MessageGroupId=name,
+            MessageDeduplicationId=uuid.uuid4().hex,
+        )
+
+    def drain(self, name, acquire):
+        return []
@@ -1,6 +1,9 @@
 import email
+import functools
 import boto3
+import keywords
 import logging
+import os
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
@@ -75,33 +78,22 @@ def extract_email_body(parsed_email):
         return text_content.decode(text_charset)
     return
 
-def search_active_words(subject, active_words):
+@functools.lru_cache(maxsize=8)
+def get_active_words_matcher(active_words, whole_words=False):
     """
-    This method looks for active_words in subject in a case-insensitive fashion
-
-    Parameters
-    ----------
-    subject: string, required
-        email subject
-    active_words: string, required
-        active words represented in a comma delimited fashion
-
-    Returns
-    -------
-    True
-        If any active words were found in subject or,
-        No active words are configured
-    False
-        If no active words were found in subject
+    Returns the KeywordMatcher for active words represented in a comma delimited fashion, or None when there are no
+    active words. Matchers are compiled once per Lambda container.
     """
-    if not active_words:
-        return True
-    else:
-        # Convert to lower case words by splitting active_words. For example: 'Hello  ,  World,' is generated as ('hello','world').
-        lower_words = [word.strip().lower() for word in filter(None, active_words.split(','))]
-        # Convert subject to lower case in order to do a case insensitive lookup.
-        subject_lower = subject.lower()
-        for word in lower_words:
-            if word in subject_lower:
-                return True
-    return False
+    # Split active_words, for example: 'Hello  ,  World,' is matched as ('hello','world').
+    words = [word.strip() for word in (active_words or '').split(',') if word.strip()]
+    if not words:
+        return None
+    return keywords.KeywordMatcher(words, whole_words)
+
+def get_env_var(name):
+    var = os.getenv(name)
+    if not var:
+        error_msg = f'{name} not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it.'
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    return var
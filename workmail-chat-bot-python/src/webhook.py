@@ -0,0 +1,99 @@
+import email.utils
+import logging
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger()
+
+# Status codes that are retried, Chime and Slack return 429 when a webhook is rate limited
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class WebhookClient:
+    """
+    Posts to webhooks over a requests.Session, so that connections are kept alive and reused by all invocations
+    that run in the same Lambda container, instead of paying a TCP and TLS handshake for every message.
+
+    Failed posts are retried with jittered exponential backoff, or after the delay given by a Retry-After header.
+    Connection errors and the status codes in RETRY_STATUS_CODES are retried; read timeouts are not, as the webhook
+    may already have posted the message. Timeouts and backoff are bounded by the deadline of the invocation.
+    """
+
+    def __init__(self, max_attempts=4, connect_timeout=3.05, read_timeout=5, backoff_base=0.25, backoff_max=4, pool_maxsize=10):
+        self.max_attempts = max_attempts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, url, payload, deadline=None):
+        """
+        Posts the payload as JSON to the webhook, retrying transient failures until deadline
+
+        Parameters
+        ----------
+        url: string, required
+            webhook URL
+        payload: dict, required
+            JSON payload
+        deadline: float, optional
+            time.monotonic() by which the post has to be done, usually derived from the remaining Lambda time
+        Returns
+        -------
+        requests.Response
+            The successful response
+        Raises
+        ------
+        requests.exceptions.RequestException:
+            When the post did not succeed within max_attempts or before deadline
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise requests.exceptions.Timeout(f"No time left to post to the webhook after {attempt - 1} attempts")
+                connect_timeout, read_timeout = min(connect_timeout, remaining), min(read_timeout, remaining)
+
+            try:
+                response = self.session.post(url, json=payload, timeout=(connect_timeout, read_timeout))
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response
+                error = requests.exceptions.HTTPError(f"{response.status_code} response from the webhook", response=response)
+                delay = self.retry_after(response)
+            except requests.exceptions.ConnectionError as e:
+                # includes ConnectTimeout, but not ReadTimeout
+                error = e
+                delay = None
+
+            if delay is None:
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+            if attempt >= self.max_attempts or (deadline is not None and time.monotonic() + delay >= deadline):
+                raise error
+            logger.info(f"Retrying post to the webhook in {delay:.2f} seconds after: {error}")
+            time.sleep(delay)
+
+    @staticmethod
+    def retry_after(response):
+        """
+        Returns the delay in seconds requested by the Retry-After header of response, or None
+        """
+        retry_after = response.headers.get('Retry-After')
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
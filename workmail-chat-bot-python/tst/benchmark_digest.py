@@ -0,0 +1,51 @@
+"""
+Replays a burst of alert emails through chat_handler, with and without digest mode, and counts the webhook posts.
+Time is simulated, so the burst replays instantly.
+
+    python tst/benchmark_digest.py
+"""
+import os
+import random
+import sys
+import types
+
+os.environ.setdefault('WEBHOOK_URL', 'https://hooks.example.test/webhook')
+os.environ.setdefault('CHAT_CLIENT', 'Slack')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import app  # noqa: E402
+import digest  # noqa: E402
+
+ALERTS = 200
+BURST_SECONDS = 60
+SENDERS = [f"monitor{i}@example.test" for i in range(5)] + [f"user{i}@example.test" for i in range(20)]
+SUBJECTS = ['Disk full on db-1', 'CPU high on web-2', 'URGENT: backup failed'] + [f"Ticket {i}" for i in range(30)]
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def run(window_seconds):
+    clock = Clock()
+    posts = []
+    app.alert_queue = digest.LocalAlertQueue(window_seconds, clock=clock) if window_seconds else None
+    app.webhook_client.post = lambda url, payload, deadline: posts.append(payload)
+    app.utils.download_email = lambda message_id: None
+    app.utils.extract_email_body = lambda parsed_email: 'Details of the alert'
+    context = types.SimpleNamespace(get_remaining_time_in_millis=lambda: 10000)
+    for arrival in sorted(random.uniform(0, BURST_SECONDS) for _ in range(ALERTS)):
+        clock.now = arrival
+        event = {'subject': random.choice(SUBJECTS), 'messageId': 'id', 'envelope': {'mailFrom': {'address': random.choice(SENDERS)}}}
+        app.chat_handler(event, context)
+    buffered = len(app.alert_queue.alerts) if app.alert_queue else 0
+    return posts, buffered
+
+random.seed(1)
+for window_seconds in (0, 5, 10, 30):
+    posts, buffered = run(window_seconds)
+    print(f"window {window_seconds:3} s: {len(posts):4} webhook posts for {ALERTS} alerts, {buffered} alerts in the last window")
+print()
+print(posts[0]['text'])
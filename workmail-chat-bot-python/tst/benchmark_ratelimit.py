@@ -0,0 +1,82 @@
+"""
+Replays a burst of alerts for one Slack destination through chat_handler, against a stand-in for a webhook that
+accepts one message per second and answers 429 to the others, with and without the rate limiter. Time is simulated,
+so the burst replays instantly.
+
+    python tst/benchmark_ratelimit.py
+"""
+import logging
+import os
+import random
+import re
+import sys
+import types
+
+import requests
+
+os.environ.setdefault('WEBHOOK_URL', 'https://hooks.example.test/webhook')
+os.environ.setdefault('CHAT_CLIENT', 'Slack')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import app  # noqa: E402
+import ratelimit  # noqa: E402
+
+ALERTS_PER_SECOND = 3
+BURST_SECONDS = 60
+PROVIDER_LIMIT_PER_SECOND = 1
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class RateLimitedWebhook:
+    """
+    Accepts one post per 1 / PROVIDER_LIMIT_PER_SECOND seconds of simulated time, and rejects the others with 429
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.last_accepted = None
+        self.accepted = []
+        self.rejected = 0
+
+    def post(self, url, payload, deadline):
+        now = self.clock()
+        if self.last_accepted is not None and now - self.last_accepted < 1 / PROVIDER_LIMIT_PER_SECOND:
+            self.rejected += 1
+            raise requests.exceptions.HTTPError('429 response from the webhook')
+        self.last_accepted = now
+        self.accepted.append(payload)
+
+def run(rate_limited):
+    clock = Clock()
+    provider = RateLimitedWebhook(clock)
+    app.webhook_client.post = provider.post
+    app.utils.download_email = lambda message_id: None
+    app.utils.extract_email_body = lambda parsed_email: 'Details of the alert'
+    app.rate_limiter = ratelimit.RateLimiter(ratelimit.LocalTokenBucketStore(), PROVIDER_LIMIT_PER_SECOND, clock=clock) if rate_limited else None
+    app.delivery_queue = ratelimit.LocalDeliveryQueue() if rate_limited else None
+    context = types.SimpleNamespace(get_remaining_time_in_millis=lambda: 10000)
+    failed_invocations = 0
+    arrivals = sorted(random.uniform(0, BURST_SECONDS) for _ in range(ALERTS_PER_SECOND * BURST_SECONDS))
+    for i, arrival in enumerate(arrivals):
+        clock.now = arrival
+        event = {'subject': f"Alert {i}", 'messageId': 'id', 'envelope': {'mailFrom': {'address': 'monitor@example.test'}}}
+        try:
+            app.chat_handler(event, context)
+        except ConnectionError:
+            failed_invocations += 1
+    queued = len(app.delivery_queue.messages.get('default', [])) if rate_limited else 0
+    texts = [payload['text'] for payload in provider.accepted]
+    in_order = texts == sorted(texts, key=lambda text: int(re.search(r'Alert (\d+)', text).group(1)))
+    print(f"{'rate limited' if rate_limited else 'unlimited':12}: {len(arrivals)} alerts, {len(provider.accepted)} posted "
+          f"({len(provider.accepted) / BURST_SECONDS:.2f}/s), {provider.rejected} rejected with 429, "
+          f"{failed_invocations} failed invocations, {queued} still queued, in order: {in_order}")
+
+logging.disable(logging.ERROR)
+random.seed(1)
+run(False)
+run(True)
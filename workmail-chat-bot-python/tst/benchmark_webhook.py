@@ -0,0 +1,80 @@
+"""
+Compares posting alerts with a new connection per message (requests.post) with the pooled WebhookClient, against a
+local HTTP stand-in for a webhook. The stand-in counts the connections it accepts, can add a handshake delay to every
+new connection, and can answer a fraction of the posts with 429 and a Retry-After header.
+
+    python tst/benchmark_webhook.py
+"""
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import webhook  # noqa: E402
+
+MESSAGES = 200
+# a TLS handshake to a chat provider typically takes a few round trips
+HANDSHAKE_SECONDS = 0.02
+
+class WebhookStandIn(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = 0
+    posts = 0
+    throttle_rate = 0.0
+
+    def setup(self):
+        super().setup()
+        WebhookStandIn.connections += 1
+        time.sleep(HANDSHAKE_SECONDS)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        WebhookStandIn.posts += 1
+        if random.random() < self.throttle_rate:
+            self.send_response(429)
+            self.send_header('Retry-After', '0.01')
+            body = b'rate limited'
+        else:
+            self.send_response(200)
+            body = b'ok'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run(name, post, throttle_rate):
+    WebhookStandIn.connections = WebhookStandIn.posts = 0
+    WebhookStandIn.throttle_rate = throttle_rate
+    failures = 0
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        try:
+            post({'text': f"Alert {i}"})
+        except requests.exceptions.RequestException:
+            failures += 1
+    elapsed = time.perf_counter() - start
+    print(f"{name:16} throttled {throttle_rate:4.0%}: {elapsed / MESSAGES * 1000:6.2f} ms/message, "
+          f"{WebhookStandIn.connections:4} connections, {WebhookStandIn.posts:4} posts, {failures:3} failed")
+
+def post_once(url, payload):
+    requests.post(url, json=payload, timeout=5).raise_for_status()
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), WebhookStandIn)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{server.server_port}/webhook"
+client = webhook.WebhookClient()
+
+random.seed(1)
+for throttle_rate in (0.0, 0.1):
+    run('requests.post', lambda payload: post_once(url, payload), throttle_rate)
+    run('WebhookClient', lambda payload: client.post(url, payload, time.monotonic() + 5), throttle_rate)
+server.shutdown()
@@ -0,0 +1,179 @@
+import json
+import logging
+import threading
+import time
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# Item of the execution table that holds the leases of the executions in flight
+COUNTER_KEY = '#InFlightExecutions'
+
+# Seconds a slot is leased for. Every retry of the invocation renews the lease, a slot whose invocation is no longer
+# retried, because it crashed or its message reached the rule timeout, is given back when the lease expires
+DEFAULT_LEASE_SECONDS = 900
+
+# Results of acquiring a slot, besides None when there is no slot left
+ACQUIRED = 'ACQUIRED'
+# the invocation holds a slot from a previous attempt
+ALREADY_HELD = 'ALREADY_HELD'
+
+def renew_leases(leases, invocation_id, limit, lease_seconds, now):
+    """
+    Returns the unexpired leases with the lease of invocation_id added or renewed and the result of acquiring the slot,
+    or None for both when there is no slot left
+    """
+    held = leases.get(invocation_id, 0) > now
+    leases = {name: expires_at for name, expires_at in leases.items() if expires_at > now}
+    if not held and len(leases) >= limit:
+        return None, None
+    leases[invocation_id] = now + lease_seconds
+    return leases, ALREADY_HELD if held else ACQUIRED
+
+class LocalAdmissionStore:
+    """
+    In-memory stand-in for DynamoDBAdmissionStore. Executions in flight are only counted per Lambda container, which
+    makes it useful for local testing and benchmarking.
+    """
+
+    def __init__(self, lease_seconds=DEFAULT_LEASE_SECONDS, clock=time.time):
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self.leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, invocation_id, limit):
+        with self._lock:
+            leases, result = renew_leases(self.leases, invocation_id, limit, self.lease_seconds, self.clock())
+            if leases is not None:
+                self.leases = leases
+            return result
+
+    def release(self, invocation_id):
+        with self._lock:
+            self.leases.pop(invocation_id, None)
+
+class DynamoDBAdmissionStore:
+    """
+    Keeps the leases of the executions in flight in a map of an item of the execution table, from invocation id to
+    expiry time. Expired leases are dropped whenever a slot is acquired, so that slots of invocations that stopped
+    being retried are given back without a separate cleanup. The item is updated with a condition on its version,
+    and read again when another invocation changed it in the meantime.
+    """
+
+    def __init__(self, table_name, lease_seconds=DEFAULT_LEASE_SECONDS, dynamodb_client=None, max_conflicts=5):
+        self.table_name = table_name
+        self.lease_seconds = lease_seconds
+        self.client = dynamodb_client or boto3.client('dynamodb')
+        self.max_conflicts = max_conflicts
+
+    def acquire(self, invocation_id, limit):
+        for _ in range(self.max_conflicts):
+            item = self.client.get_item(TableName=self.table_name, Key={'InvocationId': {'S': COUNTER_KEY}},
+                                        ConsistentRead=True).get('Item', {})
+            leases = {name: float(value['N']) for name, value in item.get('Leases', {}).get('M', {}).items()}
+            now = time.time()
+            # a lease with more than half of its time left is not renewed, which saves a write on most retries
+            if leases.get(invocation_id, 0) > now + self.lease_seconds / 2:
+                return ALREADY_HELD
+            leases, result = renew_leases(leases, invocation_id, limit, self.lease_seconds, now)
+            if leases is None:
+                return None
+
+            version = item.get('Version', {}).get('N')
+            values = {
+                ':leases': {'M': {name: {'N': str(expires_at)} for name, expires_at in leases.items()}},
+                ':one': {'N': '1'},
+            }
+            if version is not None:
+                values[':version'] = {'N': version}
+            try:
+                self.client.update_item(
+                    TableName=self.table_name,
+                    Key={'InvocationId': {'S': COUNTER_KEY}},
+                    UpdateExpression='SET Leases = :leases ADD Version :one',
+                    ConditionExpression='attribute_not_exists(Version)' if version is None else 'Version = :version',
+                    ExpressionAttributeValues=values,
+                )
+                return result
+            except ClientError as err:
+                if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise err
+                # another invocation acquired or released a slot in the meantime, read the leases again
+        return None
+
+    def release(self, invocation_id):
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={'InvocationId': {'S': COUNTER_KEY}},
+                UpdateExpression='REMOVE Leases.#invocation ADD Version :one',
+                ConditionExpression='attribute_exists(Leases.#invocation)',
+                ExpressionAttributeNames={'#invocation': invocation_id},
+                ExpressionAttributeValues={':one': {'N': '1'}},
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise err
+            # the slot was already released, or its lease expired and was dropped
+
+class AdmissionController:
+    """
+    Limits the number of state machine executions in flight, standard and express, to max_in_flight.
+
+    Over the limit, a message is either queued, i.e. acquiring a slot is retried until queue_seconds have passed, or
+    shed right away. Admitted, queued and shed messages are emitted as CloudWatch Embedded Metric Format log lines.
+    """
+
+    def __init__(self, store, max_in_flight, queue_seconds=0, namespace='WorkMail/MessageFlowStateMachine', dimension=''):
+        self.store = store
+        self.max_in_flight = max_in_flight
+        self.queue_seconds = queue_seconds
+        self.namespace = namespace
+        self.dimension = dimension
+
+    def admit(self, invocation_id, remaining_seconds):
+        """
+        Returns True when the invocation may start an execution, waiting at most queue_seconds or remaining_seconds.
+        Retries of an invocation that holds a slot are admitted without being counted again.
+        """
+        if self._acquire(invocation_id):
+            return True
+
+        deadline = time.monotonic() + min(self.queue_seconds, remaining_seconds)
+        if time.monotonic() < deadline:
+            self.emit_metric('Queued')
+            delay = 0.1
+            while time.monotonic() < deadline:
+                time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+                delay = min(delay * 2, 1)
+                if self._acquire(invocation_id):
+                    return True
+
+        self.emit_metric('Shed')
+        return False
+
+    def _acquire(self, invocation_id):
+        result = self.store.acquire(invocation_id, self.max_in_flight)
+        if result == ACQUIRED:
+            self.emit_metric('Admitted')
+        return result is not None
+
+    def release(self, invocation_id):
+        self.store.release(invocation_id)
+
+    def emit_metric(self, name):
+        # Embedded Metric Format has to be logged as a plain JSON line, without the prefix of the Lambda logger
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['StateMachine']],
+                    'Metrics': [{'Name': name, 'Unit': 'Count'}],
+                }],
+            },
+            'StateMachine': self.dimension,
+            name: 1,
+        }))
@@ -5,8 +5,15 @@ import os
 import boto3
 import time
 import json
+import random
 import sys
-from botocore.exceptions import ClientError
+import admission
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, ReadTimeoutError
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -23,15 +30,62 @@ if not machine_state_for_output:
     logger.debug(error_msg)
 
 if not os.getenv("WAIT_TIME_FOR_EXECUTION"):
-    error_msg = "'WAIT_TIME_FOR_EXECUTION' not set in environment. The default will be used."
+    error_msg = "'WAIT_TIME_FOR_EXECUTION' not set in environment. The execution will be polled until the Lambda function is about to time out."
     logger.debug(error_msg)
-wait_time_for_execution = int(os.getenv("WAIT_TIME_FOR_EXECUTION", 0))
+wait_time_for_execution = float(os.getenv("WAIT_TIME_FOR_EXECUTION", 0)) or None
+
+# Polling stops this many milliseconds before the Lambda function times out, to leave time for returning the result
+poll_safety_margin_ms = int(os.getenv("POLL_SAFETY_MARGIN_MS", 1000))
+# First and maximum delay between two describe_execution calls, the delay doubles after each call
+poll_initial_delay_ms = int(os.getenv("POLL_INITIAL_DELAY_MS", 100))
+poll_max_delay_ms = int(os.getenv("POLL_MAX_DELAY_MS", 2000))
+
+# Number of events per get_execution_history call when looking for MACHINE_STATE_FOR_OUTPUT
+history_page_size = int(os.getenv("HISTORY_PAGE_SIZE", 1000))
+# Id of the newest history event already searched for MACHINE_STATE_FOR_OUTPUT per executionArn, kept across
+# invocations of this Lambda container so that later polls only read the events added since
+history_searched = OrderedDict()
+
+# Executions that started more than this many minutes before the Date header of the message are not searched
+date_header_tolerance_minutes = int(os.getenv("DATE_HEADER_TOLERANCE_MINUTES", 15))
+# Names and executionArns seen while searching executions, kept across invocations of this Lambda container
+execution_arn_cache = OrderedDict()
+execution_arn_cache_size = 10000
+
+# If set to "true", the state machine writes its result to the Result attribute of the EXECUTION_TABLE item of the invocation
+result_from_table = os.getenv("RESULT_FROM_TABLE", "false").lower() == "true"
+
+# Optional express state machine that is run synchronously before falling back to STATE_MACHINE_ARN
+express_state_machine_arn = os.getenv("EXPRESS_STATE_MACHINE_ARN")
+express_timeout_seconds = float(os.getenv("EXPRESS_TIMEOUT_SECONDS", 10))
+# the client is created once per Lambda container, it gives up on a response after EXPRESS_TIMEOUT_SECONDS
+express_stepfunctions = None
+if express_state_machine_arn:
+    express_stepfunctions = boto3.client('stepfunctions', config=Config(read_timeout=express_timeout_seconds, retries={'total_max_attempts': 1}))
+# Invocation ids that fell back to the standard state machine in this Lambda container
+express_fallbacks = OrderedDict()
 
 execution_table = os.getenv("EXECUTION_TABLE")
 if not execution_table:
-    error_msg = "'EXECUTION_TABLE' not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it."
-    logger.error(error_msg)
-    raise ValueError(error_msg)
+    error_msg = "'EXECUTION_TABLE' not set in environment. Executions will not be recorded in DynamoDB."
+    logger.debug(error_msg)
+
+# Optional admission control: at most MAX_EXECUTIONS_IN_FLIGHT executions run at a time, counted in EXECUTION_TABLE.
+# Over the limit, OVERLOAD_ACTION is returned to WorkMail, or, when it is QUEUE, the message waits up to
+# ADMISSION_QUEUE_SECONDS for a slot before the invocation fails and WorkMail retries it later. A slot is leased for
+# ADMISSION_LEASE_SECONDS, renewed by every retry, so that slots of messages that are no longer retried are given back
+max_executions_in_flight = int(os.getenv("MAX_EXECUTIONS_IN_FLIGHT", 0))
+overload_action = os.getenv("OVERLOAD_ACTION") or "QUEUE"
+admission_lease_seconds = float(os.getenv("ADMISSION_LEASE_SECONDS", admission.DEFAULT_LEASE_SECONDS))
+admission_controller = None
+if max_executions_in_flight > 0:
+    admission_controller = admission.AdmissionController(
+        admission.DynamoDBAdmissionStore(execution_table, admission_lease_seconds) if execution_table
+        else admission.LocalAdmissionStore(admission_lease_seconds),
+        max_executions_in_flight,
+        queue_seconds=float(os.getenv("ADMISSION_QUEUE_SECONDS", 5)) if overload_action == "QUEUE" else 0,
+        dimension=state_machine_arn.split(':')[6],
+    )
 
 def orchestrator_handler(email_summary, context):
     """
@@ -85,9 +139,33 @@ def orchestrator_handler(email_summary, context):
 
     """
     logger.debug(email_summary)
+    invocation_id = email_summary['invocationId']
+
+    # Optional: limit the number of executions in flight, express or standard. Retries of an admitted invocation are always admitted
+    remaining_seconds = (context.get_remaining_time_in_millis() - poll_safety_margin_ms) / 1000
+    if admission_controller and not admission_controller.admit(invocation_id, remaining_seconds):
+        if overload_action != 'QUEUE':
+            logger.info(f"Too many state machine executions in flight, returning {overload_action}")
+            return {
+                'actions': [
+                {
+                    'allRecipients': True,
+                    'action': { 'type': overload_action }
+                }
+            ]}
+        # signal WorkMail to retry later, which keeps the message queued
+        raise Exception("Too many state machine executions in flight")
+
+    # Optional: run the express state machine synchronously, and fall back to the standard state machine when it does not succeed in time
+    if express_state_machine_arn and invocation_id not in express_fallbacks:
+        output = run_express_execution(email_summary, context)
+        if output is not None:
+            release_admission(invocation_id)
+            return output
+        remember_express_fallback(invocation_id)
+
     stepfunctions = boto3.client('stepfunctions')
     dynamodb = boto3.resource('dynamodb')
-    invocation_id = email_summary['invocationId']
     state_machine_execution_arn = ''
 
     # attempt to start the execution
@@ -102,19 +180,18 @@ def orchestrator_handler(email_summary, context):
         # expect to see ExecutionAlreadyExists on subsequent invocations
         if err.response['Error']['Code'] == 'ExecutionAlreadyExists':
 
-            # look up the executionArn in the DynamoDB table
-            state_machine_execution_arn = get_execution(execution_table, invocation_id, dynamodb)
+            # the execution is named after the invocation id, so its executionArn can be derived without a lookup
+            state_machine_execution_arn = get_execution_arn(state_machine_arn, invocation_id)
 
-            if state_machine_execution_arn == '':
-                # edge case...
-                logger.info("Unable to find executionArn from DynamoDB. This could be because of too short of TTL on the item. Searching Step Function execution history.")
-                state_machine_execution_arn = search_for_execution(stepfunctions, state_machine_arn, invocation_id)
-                if state_machine_execution_arn == '':
-                    logger.info("Unable to find execution")
-                    raise err
         else:
             logger.info("Unexpected error: %s" % err)
+            # no execution was started, so the slot is given back instead of being held until its lease expires
+            release_admission(invocation_id)
             raise err
+    except Exception:
+        # e.g. a connection error, the retry of the invocation acquires a slot again
+        release_admission(invocation_id)
+        raise
 
     # this code block runs if there was no exception
     else:
@@ -123,46 +200,171 @@ def orchestrator_handler(email_summary, context):
         logger.debug(start_execution_response)
         state_machine_execution_arn = start_execution_response['executionArn']
 
-        # save the executionArn to DynamoDB table for the next Lambda invocation to reference
-        put_execution(execution_table, invocation_id, state_machine_execution_arn, dynamodb)
-
-        # Optional: if the state machine is known to execute quickly you can wait so that the response is returned during this invocation of the function
-        time.sleep(wait_time_for_execution)
-
-    # get the results from the execution
-    state_machine_execution_history = stepfunctions.get_execution_history(
-        executionArn=state_machine_execution_arn
-    )
-    logger.debug(state_machine_execution_history['events'])
+        # Optional: record the executionArn in the DynamoDB table as an audit trail
+        if execution_table:
+            put_execution(execution_table, invocation_id, state_machine_execution_arn, dynamodb)
 
-    for state_machine_event in state_machine_execution_history['events']:
+    # Optional: read the result the state machine writes to the DynamoDB table, instead of the execution history
+    result_lookup = None
+    if result_from_table and execution_table:
+        result_lookup = lambda: get_result(execution_table, invocation_id, dynamodb)
 
-        if machine_state_for_output:
+    # wait for the output, so that the response is returned during this invocation of the function
+    try:
+        status, output = wait_for_output(stepfunctions, state_machine_execution_arn, context, result_lookup)
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ExecutionDoesNotExist':
+            raise err
 
-            if 'stateExitedEventDetails' in state_machine_event:
-                this_state_name = state_machine_event['stateExitedEventDetails']['name']
-                this_state_output = state_machine_event['stateExitedEventDetails']['output']
-                if this_state_name == machine_state_for_output:
-                    return json.loads(this_state_output)
+        # edge case, the derived executionArn does not match the one Step Functions assigned...
+        logger.info(f"Execution {state_machine_execution_arn} does not exist. Looking it up in DynamoDB and the Step Function execution history.")
+        state_machine_execution_arn = get_execution(execution_table, invocation_id, dynamodb) if execution_table else ''
+        if state_machine_execution_arn == '':
+            state_machine_execution_arn = search_for_execution(stepfunctions, state_machine_arn, invocation_id, get_search_start(email_summary))
+            if state_machine_execution_arn == '':
+                logger.info("Unable to find execution")
+                raise err
+        status, output = wait_for_output(stepfunctions, state_machine_execution_arn, context, result_lookup)
 
-        elif state_machine_event['type'] == 'ExecutionSucceeded':
+    # the execution no longer needs its admission slot once its output is available or it has ended
+    if output is not None or status != 'RUNNING':
+        release_admission(invocation_id)
 
-            if 'executionSucceededEventDetails' in state_machine_event:
-                this_execution_output = state_machine_event['executionSucceededEventDetails']['output']
-                return json.loads(this_execution_output)
+    if output is not None:
+        return output
 
     logger.debug("Unable to retrieve output from Step Function state machine state or execution.")
     raise Exception("State machine execution is not yet complete")
 
+def release_admission(invocation_id):
+    # Gives back the admission slot of the invocation, when admission control is enabled
+    if admission_controller:
+        admission_controller.release(invocation_id)
+
+def run_express_execution(email_summary, context):
+    # Runs the express state machine with start_sync_execution and returns its parsed output, or None when it did not
+    # succeed within EXPRESS_TIMEOUT_SECONDS, could not be started, or the Lambda function has less time remaining.
+    # An execution that is still running when the client gives up is not stopped, it keeps running alongside the
+    # standard execution of the fallback, so the steps of both state machines have to tolerate running twice per message
+    if (context.get_remaining_time_in_millis() - poll_safety_margin_ms) / 1000 < express_timeout_seconds:
+        return None
+    try:
+        response = express_stepfunctions.start_sync_execution(
+            name=email_summary['invocationId'],
+            stateMachineArn=express_state_machine_arn,
+            input=json.dumps(email_summary)
+        )
+    except ReadTimeoutError:
+        logger.info(f"Express execution did not finish within {express_timeout_seconds} seconds, falling back to the standard state machine")
+        return None
+    except (ClientError, BotoCoreError) as err:
+        logger.info(f"Express execution could not be run, falling back to the standard state machine: {err}")
+        return None
+    logger.debug(response)
+
+    if response['status'] != 'SUCCEEDED':
+        logger.info(f"Express execution ended with status {response['status']}, falling back to the standard state machine")
+        return None
+    return json.loads(response['output'])
+
+def remember_express_fallback(invocation_id):
+    # Retries of this invocation that reach this Lambda container skip the express state machine
+    express_fallbacks[invocation_id] = True
+    while len(express_fallbacks) > execution_arn_cache_size:
+        express_fallbacks.popitem(last=False)
+
+def get_execution_arn(state_machine_arn, execution_name):
+    # arn:<partition>:states:<region>:<account>:stateMachine:<name>[:<version or alias>]
+    # -> arn:<partition>:states:<region>:<account>:execution:<name>:<execution name>
+    arn_parts = state_machine_arn.split(':')
+    return ':'.join(arn_parts[:5] + ['execution', arn_parts[6], execution_name])
+
+def wait_for_output(stepfunctions, execution_arn, context, result_lookup=None):
+    # Poll the execution with jittered exponential backoff until its output is available, it is no longer running,
+    # WAIT_TIME_FOR_EXECUTION has passed or the Lambda function is about to time out, and return its status and output
+    # When result_lookup is given, it is tried first on every poll and the execution history is only read at the end
+    now = time.monotonic()
+    deadline = now + (context.get_remaining_time_in_millis() - poll_safety_margin_ms) / 1000
+    if wait_time_for_execution:
+        deadline = min(deadline, now + wait_time_for_execution)
+    delay = poll_initial_delay_ms / 1000
+    while True:
+        output = result_lookup() if result_lookup else None
+        if output is not None:
+            return 'SUCCEEDED', output
+        status, output = get_execution_output(stepfunctions, execution_arn, read_history=result_lookup is None)
+        remaining = deadline - time.monotonic()
+        if output is not None or status != 'RUNNING' or remaining <= 0:
+            if output is None and result_lookup:
+                logger.info("No result found in the DynamoDB table. Reading the execution history.")
+                status, output = get_execution_output(stepfunctions, execution_arn)
+            if output is None and status != 'RUNNING':
+                logger.info(f"State machine execution ended with status {status} without output")
+            return status, output
+        time.sleep(min(random.uniform(delay / 2, delay), remaining))
+        delay = min(delay * 2, poll_max_delay_ms / 1000)
+
+def get_execution_output(stepfunctions, execution_arn, read_history=True):
+    # Returns the execution status and the parsed output of MACHINE_STATE_FOR_OUTPUT or of the execution,
+    # or None when the output is not available yet, or MACHINE_STATE_FOR_OUTPUT is set and read_history is False
+    execution = stepfunctions.describe_execution(executionArn=execution_arn)
+    if not machine_state_for_output:
+        if execution['status'] == 'SUCCEEDED' and 'output' in execution:
+            return execution['status'], json.loads(execution['output'])
+        return execution['status'], None
+
+    if not read_history:
+        return execution['status'], None
+    return execution['status'], get_state_output(stepfunctions, execution_arn, machine_state_for_output)
+
+def get_state_output(stepfunctions, execution_arn, state_name):
+    # Reads the execution history newest first and returns the parsed output of the latest exit of the given state.
+    # The history is read up to its oldest event, so that a state that exits early in a long execution is found, but
+    # events that an earlier poll of the execution already searched are not read again
+    searched_event_id = history_searched.get(execution_arn, 0)
+    newest_event_id = None
+    for state_machine_event in read_history_newest_first(stepfunctions, execution_arn):
+        if newest_event_id is None:
+            newest_event_id = state_machine_event['id']
+        if state_machine_event['id'] <= searched_event_id:
+            break
+        if 'stateExitedEventDetails' in state_machine_event:
+            if state_machine_event['stateExitedEventDetails']['name'] == state_name:
+                return json.loads(state_machine_event['stateExitedEventDetails']['output'])
+
+    if newest_event_id is not None:
+        remember_history_searched(execution_arn, newest_event_id)
+    return None
+
+def read_history_newest_first(stepfunctions, execution_arn):
+    # Yields the events of the execution history newest first, a page is only read when the previous one is used up
+    args = {
+        "executionArn": execution_arn,
+        "reverseOrder": True,
+        "maxResults": history_page_size,
+    }
+    while True:
+        state_machine_execution_history = stepfunctions.get_execution_history(**args)
+        logger.debug(state_machine_execution_history['events'])
+        yield from state_machine_execution_history['events']
+        if 'nextToken' not in state_machine_execution_history:
+            return
+        args['nextToken'] = state_machine_execution_history['nextToken']
+
+def remember_history_searched(execution_arn, event_id):
+    history_searched[execution_arn] = event_id
+    history_searched.move_to_end(execution_arn)
+    while len(history_searched) > execution_arn_cache_size:
+        history_searched.popitem(last=False)
+
 def put_execution(tableName, invocationId, executionArn, dynamodb=None):
     table = dynamodb.Table(tableName)
     ttl = int( time.time() ) + 14400 # items in this table will have a TTL of 240 minutes, which is the maximum for a WorkMail rule timeout
-    response = table.put_item(
-       Item={
-            'InvocationId': invocationId,
-            'ExecutionArn': executionArn,
-            'TimeToLive': ttl,
-        }
+    # update rather than put the item, so that a Result the state machine may already have written is kept
+    response = table.update_item(
+        Key={'InvocationId': invocationId},
+        UpdateExpression='SET ExecutionArn = :arn, TimeToLive = :ttl',
+        ExpressionAttributeValues={':arn': executionArn, ':ttl': ttl},
     )
     return response
 
@@ -183,35 +385,70 @@ def get_execution(tableName, invocationId, dynamodb=None):
         logger.info("Unable to find the invocation in the DynamoDB table")
         return ''
 
-def search_for_execution(stepfunctions, state_machine_arn, invocation_id):
+def get_result(tableName, invocationId, dynamodb=None):
+    # Returns the parsed Result the state machine wrote to the item of this invocation, or None
+    table = dynamodb.Table(tableName)
+    response = table.get_item(Key={'InvocationId': invocationId}, ConsistentRead=True)
+    if 'Result' in response.get('Item', {}):
+        return json.loads(response['Item']['Result'])
+    return None
+
+def get_search_start(email_summary):
+    # Returns the earliest time an execution for this message can have started. WorkMail gives up on a message after
+    # the maximum rule timeout, and the execution starts after the message arrived, which is approximated by its Date
+    # header minus a tolerance for clock skew between the sending server and AWS
+    search_start = datetime.now(timezone.utc) - timedelta(minutes=240)
+    try:
+        raw_message = boto3.client('workmailmessageflow').get_raw_message_content(messageId=email_summary['messageId'])['messageContent']
+        header = b''
+        for chunk in raw_message.iter_chunks(4096):
+            header += chunk
+            if b'\r\n\r\n' in header or b'\n\n' in header or len(header) > 65536:
+                break
+        raw_message.close()
+        message_date = BytesHeaderParser().parsebytes(header)['Date']
+        if message_date:
+            arrival_time = parsedate_to_datetime(message_date) - timedelta(minutes=date_header_tolerance_minutes)
+            search_start = max(search_start, arrival_time)
+    except Exception as e:
+        logger.info(f"Unable to read the Date header of the message, searching executions of the last 240 minutes: {e}")
+    return search_start
+
+def search_for_execution(stepfunctions, state_machine_arn, invocation_id, search_start=None):
     # Find the executionArn (there is no way to find it by name)
-    # Note: this approach may not scale well for high volume mail flow, but this function would only be called if the execution can't be found in the dynamoDB table
-    nextToken = ''
-    while(1):
+    # Executions are listed newest first, so the search stops at the first execution that started before search_start.
+    # Only running and succeeded executions are searched, as only those can still produce output. Every execution seen
+    # is remembered, so that searches for other invocations in the same Lambda container can skip the API calls
+    if invocation_id in execution_arn_cache:
+        return execution_arn_cache[invocation_id]
 
+    for status in ('RUNNING', 'SUCCEEDED'):
         args = {
             "stateMachineArn": state_machine_arn,
-            "maxResults": 10, # This is a potentially tunable variable depending on mail flow volume
+            "statusFilter": status,
+            "maxResults": 1000,
         }
-        if nextToken:
-            args['nextToken'] = nextToken
-
-        list_executions_response = stepfunctions.list_executions(
-            **args
-        );
-        logger.debug(list_executions_response)
-
-        for execution in list_executions_response['executions']:
-            if execution['name'] == invocation_id:
-                return execution['executionArn']
-
-        if 'nextToken' in list_executions_response:
-            nextToken = list_executions_response['nextToken']
-        else:
-            return ''
-
-        # TODO: if we can easily get the date when the message arrived then we can skip all executions with startDate earlier than that
-        # fetching the message and parsing the Date header is probably the best option here
-        # logger.info(execution['startDate'])
+        while True:
+            list_executions_response = stepfunctions.list_executions(**args)
+            logger.debug(list_executions_response)
+
+            too_old = False
+            for execution in list_executions_response['executions']:
+                if search_start and execution['startDate'] < search_start:
+                    too_old = True
+                    break
+                remember_execution(execution['name'], execution['executionArn'])
+                if execution['name'] == invocation_id:
+                    return execution['executionArn']
+
+            if too_old or 'nextToken' not in list_executions_response:
+                break
+            args['nextToken'] = list_executions_response['nextToken']
 
     return ''
+
+def remember_execution(name, execution_arn):
+    execution_arn_cache[name] = execution_arn
+    execution_arn_cache.move_to_end(name)
+    while len(execution_arn_cache) > execution_arn_cache_size:
+        execution_arn_cache.popitem(last=False)
@@ -0,0 +1,41 @@
+"""
+Compares the end-to-end latency of the standard path (start_execution and polling) with the express path
+(start_sync_execution) of the orchestrator, against local stand-ins that simulate state machine latency.
+
+    python tst/benchmark_express.py
+"""
+import os
+import statistics
+import sys
+import time
+import uuid
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STATE_MACHINE_ARN', 'arn:aws:states:us-east-1:123456789012:stateMachine:Standard')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import app  # noqa: E402
+from local_aws import LocalContext, LocalStepFunctions, lognormal  # noqa: E402
+
+MESSAGES = 20
+EXPRESS_ARN = 'arn:aws:states:us-east-1:123456789012:stateMachine:Express'
+
+def run(express, median):
+    stepfunctions = LocalStepFunctions(duration=lognormal(median), api_latency=0.02)
+    app.boto3.client = lambda service, config=None: stepfunctions.client(config.read_timeout if config else None)
+    app.express_state_machine_arn = EXPRESS_ARN if express else None
+    app.express_stepfunctions = stepfunctions.client(app.express_timeout_seconds)
+    app.execution_table = None
+    latencies = []
+    for _ in range(MESSAGES):
+        start = time.perf_counter()
+        app.orchestrator_handler({'invocationId': uuid.uuid4().hex}, LocalContext())
+        latencies.append(time.perf_counter() - start)
+    return latencies, stepfunctions.calls
+
+for median in (0.05, 0.2, 1.0):
+    for express in (False, True):
+        latencies, calls = run(express, median)
+        print(f"median execution {median * 1000:5.0f} ms, {'express ' if express else 'standard'}: "
+              f"p50 {statistics.median(latencies) * 1000:7.1f} ms, max {max(latencies) * 1000:7.1f} ms, "
+              f"{calls.total() / MESSAGES:4.1f} calls/message")
@@ -0,0 +1,66 @@
+"""
+Compares reading the output of MACHINE_STATE_FOR_OUTPUT by scanning the execution history oldest first with the
+newest first lookup used by the orchestrator, against a stubbed history of thousands of events.
+
+    python tst/benchmark_history.py
+"""
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STATE_MACHINE_ARN', 'arn:aws:states:us-east-1:123456789012:stateMachine:Benchmark')
+os.environ.setdefault('EXECUTION_TABLE', 'Benchmark')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import app  # noqa: E402
+
+STATE_NAME = 'Decide'
+ITERATIONS = 20
+
+class StubStepFunctions:
+    """
+    Serves get_execution_history from an in-memory history with the output state exiting near the end
+    """
+
+    def __init__(self, event_count):
+        self.calls = 0
+        self.events = []
+        for i in range(event_count):
+            name = STATE_NAME if i == event_count - 10 else f"Step {i}"
+            self.events.append({
+                'id': i + 1,
+                'type': 'TaskStateExited',
+                'stateExitedEventDetails': {'name': name, 'output': json.dumps({'actions': [{'allRecipients': True, 'action': {'type': 'DEFAULT'}}]})},
+            })
+
+    def get_execution_history(self, executionArn, maxResults=100, reverseOrder=False, nextToken=None):
+        self.calls += 1
+        events = self.events[::-1] if reverseOrder else self.events
+        start = int(nextToken or 0)
+        response = {'events': events[start:start + maxResults]}
+        if start + maxResults < len(events):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+def forward_scan(stepfunctions, execution_arn, state_name):
+    args = {'executionArn': execution_arn}
+    while True:
+        history = stepfunctions.get_execution_history(**args)
+        for event in history['events']:
+            if 'stateExitedEventDetails' in event and event['stateExitedEventDetails']['name'] == state_name:
+                return json.loads(event['stateExitedEventDetails']['output'])
+        if 'nextToken' not in history:
+            return None
+        args['nextToken'] = history['nextToken']
+
+for event_count in (100, 1000, 5000, 20000):
+    for name, lookup in (('forward scan', forward_scan), ('newest first', app.get_state_output)):
+        stepfunctions = StubStepFunctions(event_count)
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            output = lookup(stepfunctions, 'arn', STATE_NAME)
+        elapsed = (time.perf_counter() - start) / ITERATIONS
+        print(f"{event_count:6} events, {name:12}: {stepfunctions.calls / ITERATIONS:5.1f} calls, "
+              f"{elapsed * 1000:8.3f} ms, found={output is not None}")
@@ -0,0 +1,157 @@
+"""
+Replays messages against the orchestrator, backed by the local Step Functions and DynamoDB stand-ins, and reports the
+end-to-end latency, API call counts and retry rates of the configured strategy.
+
+Every message is an invocation id that is invoked until the orchestrator returns a response or the rule times out.
+Like WorkMail, an invocation that fails or times out is retried with the same invocation id after a growing delay.
+Times are in seconds and can be scaled down to run many messages on a laptop, for example:
+
+    python tst/load_driver.py --messages 200 --median 2 --lambda-timeout 3
+    python tst/load_driver.py --messages 200 --median 2 --lambda-timeout 3 --result-table
+    python tst/load_driver.py --messages 200 --median 2 --lambda-timeout 3 --output-state Decide --history 3000
+    python tst/load_driver.py --messages 200 --median 2 --lambda-timeout 3 --no-derivable-arns --throttle-rate 0.05
+    python tst/load_driver.py --messages 200 --median 0.5 --lambda-timeout 3 --express --express-timeout 1
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('STATE_MACHINE_ARN', 'arn:aws:states:us-east-1:123456789012:stateMachine:LoadDriver')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import admission  # noqa: E402
+import app  # noqa: E402
+from local_aws import LocalContext, LocalDynamoDB, LocalStepFunctions, LocalTable, lognormal  # noqa: E402
+
+EXPRESS_ARN = 'arn:aws:states:us-east-1:123456789012:stateMachine:LoadDriverExpress'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100, help='number of messages to replay')
+    parser.add_argument('--arrival-rate', type=float, default=20, help='messages per second')
+    parser.add_argument('--median', type=float, default=1.0, help='median execution duration')
+    parser.add_argument('--sigma', type=float, default=0.5, help='spread of the lognormal execution duration')
+    parser.add_argument('--history', type=int, default=20, help='number of events in the history of an execution')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='round trip latency of an API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of API calls that are throttled')
+    parser.add_argument('--lambda-timeout', type=float, default=10, help='timeout of the Lambda function')
+    parser.add_argument('--retry-delay', type=float, default=1, help='delay before the first WorkMail retry, doubling up to 8 times it')
+    parser.add_argument('--rule-timeout', type=float, default=60, help='time after which WorkMail gives up on a message')
+    parser.add_argument('--wait', type=float, default=0, help='WAIT_TIME_FOR_EXECUTION, 0 to wait until the Lambda function times out')
+    parser.add_argument('--output-state', help='MACHINE_STATE_FOR_OUTPUT, read from the execution history')
+    parser.add_argument('--record-executions', action='store_true', help='record executions in the DynamoDB table')
+    parser.add_argument('--result-table', action='store_true', help='read the result the state machine writes to the DynamoDB table')
+    parser.add_argument('--express', action='store_true', help='try the express state machine first')
+    parser.add_argument('--express-timeout', type=float, default=1, help='EXPRESS_TIMEOUT_SECONDS, at most the Lambda timeout')
+    parser.add_argument('--max-in-flight', type=int, default=0, help='MAX_EXECUTIONS_IN_FLIGHT, 0 for no admission control')
+    parser.add_argument('--no-derivable-arns', action='store_true', help='make the orchestrator look up execution ARNs on retries')
+    parser.add_argument('--seed', type=int, help='random seed')
+    return parser.parse_args()
+
+def configure(args):
+    """
+    Points the orchestrator at the local stand-ins and applies the strategy of the command line arguments
+    """
+    table = LocalTable(api_latency=args.api_latency, throttle_rate=args.throttle_rate)
+    stepfunctions = LocalStepFunctions(
+        duration=lognormal(args.median, args.sigma),
+        api_latency=args.api_latency,
+        history_size=lambda: args.history,
+        output_state=args.output_state,
+        result_table=table if args.result_table else None,
+        derivable_arns=not args.no_derivable_arns,
+        calls=table.calls,
+        throttle_rate=args.throttle_rate,
+    )
+    app.boto3.client = lambda service, config=None: stepfunctions.client(config.read_timeout if config else None)
+    app.boto3.resource = lambda service: LocalDynamoDB(table)
+
+    app.wait_time_for_execution = args.wait or None
+    app.machine_state_for_output = args.output_state
+    app.execution_table = table.name if args.record_executions or args.result_table else None
+    app.result_from_table = args.result_table
+    app.express_state_machine_arn = EXPRESS_ARN if args.express else None
+    app.express_timeout_seconds = args.express_timeout
+    app.express_stepfunctions = stepfunctions.client(args.express_timeout)
+    app.execution_arn_cache.clear()
+    app.history_searched.clear()
+    app.express_fallbacks.clear()
+    app.admission_controller = None
+    admissions = {}
+    if args.max_in_flight:
+        app.admission_controller = admission.AdmissionController(admission.LocalAdmissionStore(), args.max_in_flight, queue_seconds=5)
+        app.admission_controller.emit_metric = lambda name: admissions.__setitem__(name, admissions.get(name, 0) + 1)
+    return stepfunctions, admissions
+
+class Message:
+    """
+    Invokes the orchestrator for one message the way WorkMail does, retrying until the rule times out
+    """
+
+    def __init__(self, args, arrival):
+        self.args = args
+        self.arrival = arrival
+        self.invocation_id = uuid.uuid4().hex
+        self.invocations = 0
+        self.failures = 0
+        self.latency = None
+
+    def run(self):
+        time.sleep(max(self.arrival - time.monotonic(), 0))
+        delay = self.args.retry_delay
+        while time.monotonic() - self.arrival < self.args.rule_timeout:
+            self.invocations += 1
+            invocation_start = time.monotonic()
+            try:
+                app.orchestrator_handler({'invocationId': self.invocation_id, 'flowDirection': 'INBOUND'}, LocalContext(self.args.lambda_timeout))
+                if time.monotonic() - invocation_start <= self.args.lambda_timeout:
+                    self.latency = time.monotonic() - self.arrival
+                    return self
+            except Exception:
+                pass
+            # a failed invocation, or one that returned after the Lambda function would have timed out
+            self.failures += 1
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, self.args.retry_delay * 8)
+        return self
+
+def percentile(values, fraction):
+    return sorted(values)[min(int(len(values) * fraction), len(values) - 1)]
+
+def report(messages, stepfunctions, admissions, elapsed):
+    latencies = [message.latency for message in messages if message.latency is not None]
+    invocations = sum(message.invocations for message in messages)
+    failures = sum(message.failures for message in messages)
+    print(f"{len(messages)} messages in {elapsed:.1f} s, {len(messages) - len(latencies)} timed out")
+    if latencies:
+        print(f"end-to-end latency: p50 {statistics.median(latencies):.2f} s, p95 {percentile(latencies, 0.95):.2f} s, "
+              f"p99 {percentile(latencies, 0.99):.2f} s, max {max(latencies):.2f} s")
+    print(f"invocations: {invocations / len(messages):.2f} per message, {failures / invocations:.1%} retried")
+    counts = stepfunctions.calls.counts
+    print(f"API calls: {stepfunctions.calls.total() / len(messages):.2f} per message")
+    for operation in sorted(key for key in counts if ':' not in key):
+        print(f"    {operation:24} {counts[operation] / len(messages):7.2f} per message, "
+              f"{counts.get(operation + ':throttled', 0):5} throttled, {counts.get(operation + ':retried', 0):5} retried")
+    if admissions:
+        print("admission: " + ", ".join(f"{name} {count}" for name, count in sorted(admissions.items())))
+
+def main():
+    args = parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    stepfunctions, admissions = configure(args)
+    start = time.monotonic()
+    messages = [Message(args, start + i / args.arrival_rate) for i in range(args.messages)]
+    # one thread per message, as every message waits in its own Lambda invocation
+    with ThreadPoolExecutor(max_workers=args.messages) as executor:
+        list(executor.map(Message.run, messages))
+    report(messages, stepfunctions, admissions, time.monotonic() - start)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+In-process stand-ins for the Step Functions and DynamoDB calls made by the orchestrator, used by the benchmarks and
+the load driver in this folder.
+
+Executions do not run any states: each one finishes after a duration drawn from a configurable distribution, and
+its history consists of a configurable number of state events. Every API call sleeps for a simulated round trip
+latency, and may be throttled; throttled calls are retried like boto3 does, up to max_attempts.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+class CallCounter:
+    """
+    Counts API calls, retries and throttles per operation, shared by the stand-ins of one simulation
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, count=1):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def total(self, prefix=''):
+        return sum(count for key, count in self.counts.items() if key.startswith(prefix) and ':' not in key[len(prefix):])
+
+class LocalService:
+    """
+    Simulates latency, throttling and client side retries of API calls
+    """
+
+    def __init__(self, calls=None, api_latency=0.01, throttle_rate=0.0, max_attempts=3):
+        self.calls = calls or CallCounter()
+        self.api_latency = api_latency
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+
+    def _call(self, operation):
+        for attempt in range(1, self.max_attempts + 1):
+            self.calls.add(operation)
+            time.sleep(self.api_latency)
+            if random.random() >= self.throttle_rate:
+                return
+            self.calls.add(f"{operation}:throttled")
+            if attempt < self.max_attempts:
+                self.calls.add(f"{operation}:retried")
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        raise client_error('ThrottlingException', operation)
+
+class LocalStepFunctions(LocalService):
+    """
+    Stand-in for a boto3 Step Functions client
+
+    duration: function returning the number of seconds an execution runs
+    history_size: function returning the number of events in the history of an execution
+    output_state: name of the state whose exit is recorded close to the end of the history
+    result_table: LocalTable the executions write their output to, as the Save Result state does
+    derivable_arns: when False, execution ARNs get a random suffix, so that the orchestrator has to look them up
+    """
+
+    def __init__(self, duration=lambda: 0.2, api_latency=0.01, output=None, read_timeout=None, history_size=lambda: 10,
+                 output_state=None, result_table=None, derivable_arns=True, **kwargs):
+        super().__init__(api_latency=api_latency, **kwargs)
+        self.duration = duration
+        self.output = output or {'actions': [{'allRecipients': True, 'action': {'type': 'DEFAULT'}}]}
+        self.read_timeout = read_timeout
+        self.history_size = history_size
+        self.output_state = output_state
+        self.result_table = result_table
+        self.derivable_arns = derivable_arns
+        self.executions = {}
+        self.names = set()
+        self._lock = threading.Lock()
+
+    def client(self, read_timeout=None):
+        """
+        Returns a client that shares executions and call counts with this one, but has its own read timeout
+        """
+        other = LocalStepFunctions(self.duration, self.api_latency, self.output, read_timeout, self.history_size,
+                                   self.output_state, self.result_table, self.derivable_arns, calls=self.calls,
+                                   throttle_rate=self.throttle_rate, max_attempts=self.max_attempts)
+        other.executions = self.executions
+        other.names = self.names
+        other._lock = self._lock
+        return other
+
+    def _status(self, execution):
+        if time.monotonic() < execution['endTime']:
+            return 'RUNNING'
+        if self.result_table is not None and not execution.get('resultWritten'):
+            execution['resultWritten'] = True
+            self.result_table.items.setdefault(execution['name'], {'InvocationId': execution['name']})['Result'] = json.dumps(self.output)
+        return 'SUCCEEDED'
+
+    def _execution(self, execution_arn, operation):
+        if execution_arn not in self.executions:
+            raise client_error('ExecutionDoesNotExist', operation)
+        return self.executions[execution_arn]
+
+    def start_execution(self, name, stateMachineArn, input):
+        self._call('start_execution')
+        execution_arn = stateMachineArn.replace(':stateMachine:', ':execution:') + ':' + name
+        if not self.derivable_arns:
+            execution_arn += ':' + uuid.uuid4().hex
+        with self._lock:
+            if name in self.names:
+                raise client_error('ExecutionAlreadyExists', 'StartExecution')
+            self.names.add(name)
+            now = time.monotonic()
+            self.executions[execution_arn] = {
+                'name': name,
+                'executionArn': execution_arn,
+                'startTime': now,
+                'startDate': datetime.now(timezone.utc),
+                'endTime': now + self.duration(),
+                'historySize': self.history_size(),
+                'input': input,
+            }
+        return {'executionArn': execution_arn}
+
+    def start_sync_execution(self, name, stateMachineArn, input):
+        self._call('start_sync_execution')
+        duration = self.duration()
+        if self.read_timeout is not None and duration > self.read_timeout:
+            time.sleep(self.read_timeout)
+            raise ReadTimeoutError(endpoint_url='https://sync-states.local')
+        time.sleep(duration)
+        return {'status': 'SUCCEEDED', 'output': json.dumps(self.output)}
+
+    def describe_execution(self, executionArn):
+        self._call('describe_execution')
+        execution = self._execution(executionArn, 'DescribeExecution')
+        response = {'executionArn': executionArn, 'status': self._status(execution)}
+        if response['status'] == 'SUCCEEDED':
+            response['output'] = json.dumps(self.output)
+        return response
+
+    def get_execution_history(self, executionArn, maxResults=100, reverseOrder=False, nextToken=None):
+        self._call('get_execution_history')
+        execution = self._execution(executionArn, 'GetExecutionHistory')
+        # the history grows linearly while the execution runs, the output state exits 5 events before the end
+        size = execution['historySize']
+        if self._status(execution) == 'RUNNING':
+            progress = (time.monotonic() - execution['startTime']) / (execution['endTime'] - execution['startTime'])
+            size = int(size * progress)
+        output_event = execution['historySize'] - 5
+        event_ids = range(size, 0, -1) if reverseOrder else range(1, size + 1)
+        start = int(nextToken or 0)
+        events = []
+        for event_id in event_ids[start:start + maxResults]:
+            name = self.output_state if event_id == output_event else f"State {event_id}"
+            events.append({
+                'id': event_id,
+                'type': 'TaskStateExited',
+                'stateExitedEventDetails': {'name': name, 'output': json.dumps(self.output)},
+            })
+        response = {'events': events}
+        if start + maxResults < len(event_ids):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    def list_executions(self, stateMachineArn, maxResults=100, statusFilter=None, nextToken=None):
+        self._call('list_executions')
+        executions = sorted(self.executions.values(), key=lambda execution: execution['startTime'], reverse=True)
+        if statusFilter:
+            executions = [execution for execution in executions if self._status(execution) == statusFilter]
+        start = int(nextToken or 0)
+        response = {'executions': [{'name': execution['name'], 'executionArn': execution['executionArn'],
+                                    'startDate': execution['startDate']} for execution in executions[start:start + maxResults]]}
+        if start + maxResults < len(executions):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+class LocalTable(LocalService):
+    """
+    Stand-in for a boto3 DynamoDB Table resource, supporting the SET update expressions used by the orchestrator
+    """
+
+    def __init__(self, name='ExecutionTable', **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.items = {}
+
+    def put_item(self, Item):
+        self._call('put_item')
+        self.items[Item['InvocationId']] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        self._call('update_item')
+        item = self.items.setdefault(Key['InvocationId'], dict(Key))
+        for assignment in UpdateExpression[len('SET '):].split(','):
+            attribute, value = (part.strip() for part in assignment.split('='))
+            item[attribute] = ExpressionAttributeValues[value]
+
+    def get_item(self, Key, ConsistentRead=False):
+        self._call('get_item')
+        item = self.items.get(Key['InvocationId'])
+        return {'Item': dict(item)} if item else {}
+
+class LocalDynamoDB:
+    """
+    Stand-in for the boto3 DynamoDB service resource
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def Table(self, name):
+        return self.table
+
+class LocalContext:
+    """
+    Stand-in for the Lambda context object
+    """
+
+    def __init__(self, timeout_seconds=60):
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+def lognormal(median, sigma=0.5):
+    """
+    Returns an execution duration distribution with the given median in seconds
+    """
+    return lambda: random.lognormvariate(0, sigma) * median
@@ -1,10 +1,16 @@
 import logging
 import utils
+import snapshot
+import policies
+import storm
 import os
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+policy_engine = None
+storm_guard = None
+
 def restricted_mailboxes_handler(email_summary, context):
     """
     Restricted Mailboxes for Amazon WorkMail
@@ -84,74 +90,91 @@ def restricted_mailboxes_handler(email_summary, context):
     """
     logger.info(email_summary)
     organization_id = utils.get_env_var('WORKMAIL_ORGANIZATION_ID')
-    restricted_group = utils.get_env_var('RESTRICTED_GROUP_NAME')
     report_mailbox_address = os.getenv('REPORT_MAILBOX_ADDRESS')
 
-    sender = email_summary['envelope']['mailFrom']
-    recipients = email_summary['envelope']['recipients']
     flow_direction = email_summary['flowDirection']
-
-    if flow_direction == 'INBOUND':
-        # 1. First check if sender is an external email address
-        is_sender_external = utils.filter_external([sender], organization_id) is not None
-        if is_sender_external:
-            # 2. Then filter out restricted recipients a.k.a the ones that have restricted mailboxes from all email recipients
-            restricted_recipients = utils.filter_restricted(recipients, organization_id, restricted_group)
-            if restricted_recipients:
-                # 3. Bounce this email for all restricted recipients and allow for the rest
-                logger.info(f"Received email from external source {sender} to restricted mailboxes {restricted_recipients}; bouncing! ")
-                additional_recipients = [] # Tip: You may add any additional recipients you would like to send copy of this email
-                if report_mailbox_address:
-                    additional_recipients.append(report_mailbox_address)
-                return {
-                      'actions': [
-                      {
-                        'recipients': restricted_recipients,    # Bounce this email for restricted_recipients
-                        'action' : { 'type': 'BOUNCE' }
-                      },
-                      {
-                        'recipients': additional_recipients,    # For any additional recipients and;
-                        'allRecipients': True,                  # for all the remaining recipients (i.e. except the ones in bounce action)
-                        'action' : { 'type': 'DEFAULT' }        # let the email be sent normally
-                      }
-                    ]}
-
-    elif flow_direction == 'OUTBOUND':
-        # 1. First check if sender is restricted a.k.a sender has an restricted mailbox
-        is_sender_restricted = utils.filter_restricted([sender], organization_id, restricted_group) is not None
-        if is_sender_restricted:
-            # 2. Then filter out external email addresses from all email recipients
-            external_recipients = utils.filter_external(recipients, organization_id)
-            if external_recipients:
-                # 3. Finally bounce this email for all external recipients and allow for the rest
-                logger.info(f"Restricted mailbox {sender} attempted to send to external recipient {external_recipients}; bouncing!")
-                additional_recipients = [] # Tip: You may add any additional recipients you would like to send copy of this email
-                if report_mailbox_address:
-                    additional_recipients.append(report_mailbox_address)
-                return {
-                      'actions': [
-                      {
-                        'recipients': external_recipients,      # Bounce this email for external recipients
-                        'action' : {
-                          'type': 'BOUNCE',
-                          'parameters': { 'bounceMessage': "Sending e-mails to external domains is against company policy." }
-                        },
-                      },
-                      {
-                        'recipients': additional_recipients,    # For any additional recipients and;
-                        'allRecipients': True,                  # for all the remaining recipients (i.e. except the in bounce action)
-                        'action' : { 'type': 'DEFAULT' }        # let the email be sent normally
-                      }
-                    ]}
-
-    else:
+    if flow_direction not in ('INBOUND', 'OUTBOUND'):
         error_msg = f"Received invalid flow direction:{flow_direction} in message summary"
         logger.error(error_msg)
+        return {
+              'actions': [
+              {
+                'allRecipients': True,                  # For all recipients
+                'action' : { 'type' : 'DEFAULT' }       # let the email be sent normally
+              }
+            ]}
 
-    return {
-          'actions': [
-          {
-            'allRecipients': True,                  # For all recipients
-            'action' : { 'type' : 'DEFAULT' }       # let the email be sent normally
-          }
-        ]}
+    additional_recipients = [] # Tip: You may add any additional recipients you would like to send copy of this email
+    if report_mailbox_address:
+        additional_recipients.append(report_mailbox_address)
+
+    # Bounce this email for protected recipients that are in a mail storm
+    storm_recipients = []
+    guard = get_storm_guard()
+    if guard:
+        storm_recipients = guard.check([recipient['address'] for recipient in email_summary['envelope']['recipients']])
+    if storm_recipients:
+        logger.info(f"Mail storm in progress for {storm_recipients}; bouncing!")
+        email_summary = dict(email_summary, envelope=dict(email_summary['envelope'], recipients=[
+            recipient for recipient in email_summary['envelope']['recipients'] if recipient['address'] not in storm_recipients]))
+
+    # Bounce this email for all recipients that violate a policy and allow for the rest
+    response = get_policy_engine().evaluate(email_summary, organization_id, additional_recipients)
+    if storm_recipients:
+        response['actions'].insert(0, {
+            'recipients': storm_recipients,     # Bounce this email for recipients in a mail storm
+            'action' : { 'type': 'BOUNCE' }
+        })
+    return response
+
+def get_policy_engine():
+    """
+    Returns the policy engine, policies are loaded and compiled once per Lambda container
+    """
+    global policy_engine
+    if policy_engine is None:
+        policy_engine = policies.PolicyEngine(policies.load_policies())
+    return policy_engine
+
+def get_storm_guard():
+    """
+    Returns the mail storm guard, or None when PROTECTED_ADDRESSES is not set. Counters are shared through
+    STORM_TABLE when it is set, otherwise they are kept in memory of this Lambda container
+    """
+    global storm_guard
+    protected_addresses = os.getenv('PROTECTED_ADDRESSES')
+    if storm_guard is None and protected_addresses:
+        storm_table = os.getenv('STORM_TABLE')
+        storm_guard = storm.StormGuard(
+            protected_addresses.split(','),
+            int(os.getenv('STORM_THRESHOLD', 20)),
+            int(os.getenv('STORM_WINDOW_SECONDS', 60)),
+            storm.DynamoDBCounterStore(storm_table) if storm_table else storm.LocalCounterStore(),
+        )
+    return storm_guard
+
+def membership_snapshot_handler(event, context):
+    """
+    Builds the restricted membership snapshot and stores it in S3. Runs on a schedule, see template.yaml
+
+    Parameters
+    ----------
+    event: dict, required
+        Amazon EventBridge scheduled event, its content is not used
+
+    context: object, required
+    Lambda Context runtime methods and attributes
+
+    Returns
+    -------
+    dict
+        Number of entries and size in bytes of the uploaded snapshot
+    """
+    organization_id = utils.get_env_var('WORKMAIL_ORGANIZATION_ID')
+    restricted_group = utils.get_env_var('RESTRICTED_GROUP_NAME')
+    bucket = utils.get_env_var('SNAPSHOT_S3_BUCKET')
+
+    addresses = utils.get_member_addresses(organization_id, restricted_group)
+    size = snapshot.upload_snapshot(bucket, utils.SNAPSHOT_S3_KEY, addresses)
+    logger.info(f"Uploaded snapshot of {len(addresses)} entries ({size} bytes) to s3://{bucket}/{utils.SNAPSHOT_S3_KEY}")
+    return {'entries': len(addresses), 'size': size}
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+class TTLCache:
+    """
+    Container level cache that lives across warm Lambda invocations.
+
+    Entries younger than ttl seconds are served from memory. Entries older than ttl, but younger than
+    ttl + stale_ttl, are still served from memory while a background thread reloads them
+    (stale-while-revalidate). Anything older is loaded synchronously. When the cache grows beyond
+    max_entries, the least recently used entry is evicted.
+    """
+
+    def __init__(self, ttl, stale_ttl=None, max_entries=128):
+        self.ttl = ttl
+        self.stale_ttl = ttl if stale_ttl is None else stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (value, loaded_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Returns cached value for key, calling loader() to (re)load it when needed
+        Parameters
+        ----------
+        key: hashable, required
+            Cache key
+        loader: callable, required
+            Function without arguments that returns a fresh value for key
+        Returns
+        -------
+        object
+            The cached or freshly loaded value
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                value, loaded_at = entry
+                age = now - loaded_at
+                if age < self.ttl:
+                    return value
+                if age < self.ttl + self.stale_ttl:
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                    return value
+
+        value = loader()
+        self._put(key, value)
+        return value
+
+    def get_many(self, keys, loader):
+        """
+        Returns cached values for several keys, calling loader once for all keys that need to be (re)loaded
+        Parameters
+        ----------
+        keys: iterable, required
+            Cache keys
+        loader: callable, required
+            Function that takes a list of keys and returns a dict with a fresh value for each of them
+        Returns
+        -------
+        dict
+            The cached or freshly loaded value of every key
+        """
+        now = time.monotonic()
+        values = {}
+        missing = []
+        stale = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    missing.append(key)
+                    continue
+                self._entries.move_to_end(key)
+                value, loaded_at = entry
+                age = now - loaded_at
+                if age < self.ttl + self.stale_ttl:
+                    values[key] = value
+                    if age >= self.ttl and key not in self._refreshing:
+                        self._refreshing.add(key)
+                        stale.append(key)
+                else:
+                    missing.append(key)
+        if stale:
+            threading.Thread(target=self._refresh_many, args=(stale, loader), daemon=True).start()
+
+        if missing:
+            loaded = loader(missing)
+            for key, value in loaded.items():
+                self._put(key, value)
+            values.update(loaded)
+        return values
+
+    def invalidate(self, key=None):
+        """
+        Drops a single key, or every key when key is None
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _refresh(self, key, loader):
+        try:
+            self._put(key, loader())
+        except Exception as e:
+            # Keep serving the stale value; the next synchronous load will surface the error
+            logger.warning(f"Background refresh of {key} failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh_many(self, keys, loader):
+        try:
+            for key, value in loader(keys).items():
+                self._put(key, value)
+        except Exception as e:
+            logger.warning(f"Background refresh of {len(keys)} keys failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+
+    def _put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
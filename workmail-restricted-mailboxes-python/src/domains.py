@@ -0,0 +1,39 @@
+class DomainIndex:
+    """
+    Set of internal domains with optional subdomain matching.
+
+    Domains are stored as exact names, or as suffixes when written as "*.example.test" (any subdomain of example.test)
+    or ".example.test" (example.test itself and any of its subdomains). A lookup checks the domain and each of its
+    parent domains, so its cost depends only on the number of labels in the address, not on the number of domains.
+    """
+
+    def __init__(self, domains):
+        exact = set()
+        suffixes = set()
+        for domain in domains:
+            domain = domain.strip().lower()
+            if domain.startswith('*.'):
+                suffixes.add(domain[2:])
+            elif domain.startswith('.'):
+                exact.add(domain[1:])
+                suffixes.add(domain[1:])
+            elif domain:
+                exact.add(domain)
+        self.exact = frozenset(exact)
+        self.suffixes = frozenset(suffixes)
+
+    def __contains__(self, domain):
+        domain = domain.lower()
+        if domain in self.exact:
+            return True
+        if not self.suffixes:
+            return False
+        dot = domain.find('.')
+        while dot != -1:
+            if domain[dot + 1:] in self.suffixes:
+                return True
+            dot = domain.find('.', dot + 1)
+        return False
+
+    def __len__(self):
+        return len(self.exact) + len(self.suffixes)
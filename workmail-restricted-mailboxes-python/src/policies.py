@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import utils
+from collections import namedtuple
+from domains import DomainIndex
+
+logger = logging.getLogger()
+
+# Members of the group may not receive emails from external senders
+NO_EXTERNAL_INBOUND = 'NO_EXTERNAL_INBOUND'
+# Members of the group may not send emails to external recipients
+NO_EXTERNAL_OUTBOUND = 'NO_EXTERNAL_OUTBOUND'
+# Members of the group may only send emails to internal recipients and to the policy's domains
+INTERNAL_ONLY = 'INTERNAL_ONLY'
+
+POLICY_TYPES = (NO_EXTERNAL_INBOUND, NO_EXTERNAL_OUTBOUND, INTERNAL_ONLY)
+DEFAULT_OUTBOUND_BOUNCE_MESSAGE = "Sending e-mails to external domains is against company policy."
+
+Policy = namedtuple('Policy', ['group', 'type', 'bounce_message', 'domains'])
+
+def load_policies():
+    """
+    Loads policies from the POLICIES environment variable, a JSON list such as:
+
+        [
+            { "group": "Interns", "type": "NO_EXTERNAL_INBOUND" },
+            { "group": "Interns", "type": "NO_EXTERNAL_OUTBOUND", "bounceMessage": "Not allowed" },
+            { "group": "Contractors", "type": "INTERNAL_ONLY", "domains": ["partner.test", "*.customer.test"] }
+        ]
+
+    When POLICIES is not set, RESTRICTED_GROUP_NAME is restricted from receiving and sending external emails
+
+    Returns
+    -------
+    list
+        A list of Policy, in order of precedence
+    Raises
+    ------
+    ValueError:
+        When a policy is invalid, or neither POLICIES nor RESTRICTED_GROUP_NAME is set
+    """
+    policies_json = os.getenv('POLICIES')
+    if not policies_json:
+        restricted_group = utils.get_env_var('RESTRICTED_GROUP_NAME')
+        return [
+            Policy(restricted_group, NO_EXTERNAL_INBOUND, None, None),
+            Policy(restricted_group, NO_EXTERNAL_OUTBOUND, DEFAULT_OUTBOUND_BOUNCE_MESSAGE, None),
+        ]
+
+    policies = []
+    for policy in json.loads(policies_json):
+        if policy.get('type') not in POLICY_TYPES or not policy.get('group'):
+            raise ValueError(f"Invalid policy:{policy}, expected a group and a type in {POLICY_TYPES}")
+        bounce_message = policy.get('bounceMessage')
+        if bounce_message is None and policy['type'] != NO_EXTERNAL_INBOUND:
+            bounce_message = DEFAULT_OUTBOUND_BOUNCE_MESSAGE
+        domains = DomainIndex(policy.get('domains', [])) if policy['type'] == INTERNAL_ONLY else None
+        policies.append(Policy(policy['group'], policy['type'], bounce_message, domains))
+    return policies
+
+class PolicyEngine:
+    """
+    Evaluates all policies for a message in a single pass over its recipients.
+
+    Every address is reduced to a class: whether it is external, a bitmask of the policy groups it belongs to and, for
+    recipients, a bitmask of the INTERNAL_ONLY policies whose domains it matches. The action for a (direction, sender
+    class, recipient class) combination is computed once and kept in a decision table, so recipients are classified
+    with dict lookups and grouped by their decision.
+    """
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.groups = tuple(dict.fromkeys(policy.group for policy in policies))
+        self._group_bits = [1 << self.groups.index(policy.group) for policy in policies]
+        self._decisions = {}
+        self._snapshot_group = None
+        self._snapshot_bit = 0
+        if utils.SNAPSHOT_S3_BUCKET:
+            # The snapshot only covers RESTRICTED_GROUP_NAME, other groups are resolved through their members' addresses
+            snapshot_group = os.getenv('RESTRICTED_GROUP_NAME')
+            if snapshot_group in self.groups:
+                self._snapshot_group = snapshot_group
+                self._snapshot_bit = 1 << self.groups.index(snapshot_group)
+        # None in place of the group served by the snapshot, so that its members are not listed
+        self._indexed_groups = tuple(None if group == self._snapshot_group else group for group in self.groups)
+
+    def evaluate(self, email_summary, organization_id, additional_recipients=()):
+        """
+        Returns Amazon WorkMail Sync Lambda Response for the given message
+        Parameters
+        ----------
+        email_summary: dict, required
+            Amazon WorkMail Message Summary
+        organization_id: string, required
+            Amazon WorkMail organization id
+        additional_recipients: list, optional
+            Email addresses that receive a copy of the message when any recipient was bounced
+        Returns
+        -------
+        dict
+            Amazon WorkMail Sync Lambda Response
+        """
+        direction = email_summary['flowDirection']
+        allowed_domains = utils.get_allowed_domains(organization_id)
+        address_masks = utils.get_address_masks(organization_id, self._indexed_groups) if any(self._indexed_groups) else {}
+        snapshot = utils.get_membership_snapshot() if self._snapshot_group else None
+        domain_classes = {}
+
+        def classify(address):
+            address = address.lower()
+            domain = address.rpartition('@')[2]
+            domain_class = domain_classes.get(domain)
+            if domain_class is None:
+                domain_class = domain_classes[domain] = self._classify_domain(domain, allowed_domains)
+            mask = address_masks.get(address, 0)
+            if snapshot is not None and address in snapshot:
+                mask |= self._snapshot_bit
+            return (domain_class[0], mask, domain_class[1])
+
+        sender = email_summary['envelope']['mailFrom']['address']
+        sender_external, sender_mask, _ = classify(sender)
+        sender_class = (sender_external, sender_mask)
+
+        bounced = {}
+        for recipient in email_summary['envelope']['recipients']:
+            key = (direction, sender_class, classify(recipient['address']))
+            if key not in self._decisions:
+                self._decisions[key] = self._decide(*key)
+            decision = self._decisions[key]
+            if decision is not False:
+                bounced.setdefault(decision, []).append(recipient['address'])
+
+        if not bounced:
+            return {
+                  'actions': [
+                  {
+                    'allRecipients': True,                  # For all recipients
+                    'action' : { 'type' : 'DEFAULT' }       # let the email be sent normally
+                  }
+                ]}
+
+        actions = []
+        for bounce_message, recipients in bounced.items():
+            logger.info(f"Email from {sender} violates policy for recipients {recipients}; bouncing!")
+            action = { 'type': 'BOUNCE' }
+            if bounce_message:
+                action['parameters'] = { 'bounceMessage': bounce_message }
+            actions.append({ 'recipients': recipients, 'action': action })
+        actions.append({
+            'recipients': list(additional_recipients),  # For any additional recipients and;
+            'allRecipients': True,                      # for all the remaining recipients (i.e. except the ones in bounce actions)
+            'action' : { 'type': 'DEFAULT' }            # let the email be sent normally
+        })
+        return { 'actions': actions }
+
+    def _classify_domain(self, domain, allowed_domains):
+        allowed_mask = 0
+        for bit, policy in enumerate(self.policies):
+            if policy.domains is not None and domain in policy.domains:
+                allowed_mask |= 1 << bit
+        return (domain not in allowed_domains, allowed_mask)
+
+    def _decide(self, direction, sender_class, recipient_class):
+        """
+        Returns the bounce message (None for a bounce without message) of the first matching policy, or False
+        """
+        sender_external, sender_mask = sender_class
+        recipient_external, recipient_mask, recipient_allowed_mask = recipient_class
+        for bit, (policy, group_bit) in enumerate(zip(self.policies, self._group_bits)):
+            if direction == 'INBOUND' and policy.type == NO_EXTERNAL_INBOUND:
+                if sender_external and recipient_mask & group_bit:
+                    return policy.bounce_message
+            elif direction == 'OUTBOUND' and policy.type == NO_EXTERNAL_OUTBOUND:
+                if sender_mask & group_bit and recipient_external:
+                    return policy.bounce_message
+            elif direction == 'OUTBOUND' and policy.type == INTERNAL_ONLY:
+                if sender_mask & group_bit and recipient_external and not recipient_allowed_mask & (1 << bit):
+                    return policy.bounce_message
+        return False
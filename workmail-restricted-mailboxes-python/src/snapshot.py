@@ -0,0 +1,111 @@
+import bisect
+import boto3
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger()
+s3_client = boto3.client('s3')
+
+# Snapshot file layout, all integers little-endian:
+#   magic (4 bytes) | version (uint32) | count (uint32)
+#   offsets: count + 1 uint32 values, relative to the start of the data section
+#   data: sorted, deduplicated utf-8 encoded keys concatenated without separators
+MAGIC = b'WMRS'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+OFFSET = struct.Struct('<I')
+
+def build_snapshot(keys):
+    """
+    Serializes keys into the compact sorted snapshot format
+    Parameters
+    ----------
+    keys: iterable, required
+        Strings to store, they are lowercased and deduplicated
+    Returns
+    -------
+    bytes
+        Snapshot file content
+    """
+    encoded = sorted({key.lower().encode('utf-8') for key in keys})
+    offsets = [0]
+    for key in encoded:
+        offsets.append(offsets[-1] + len(key))
+    return b''.join([
+        HEADER.pack(MAGIC, VERSION, len(encoded)),
+        struct.pack(f'<{len(offsets)}I', *offsets),
+        *encoded,
+    ])
+
+class MembershipSnapshot:
+    """
+    Read-only view over a snapshot file. The file is memory mapped and queried with binary search, so memory use and
+    load time do not depend on the number of keys it holds.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a restricted membership snapshot")
+        self._offsets_start = HEADER.size
+        self._data_start = self._offsets_start + (self._count + 1) * OFFSET.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        start, end = struct.unpack_from('<II', self._map, self._offsets_start + index * OFFSET.size)
+        return self._map[self._data_start + start:self._data_start + end]
+
+    def __contains__(self, key):
+        encoded = key.lower().encode('utf-8')
+        index = bisect.bisect_left(self, encoded)
+        return index < self._count and self[index] == encoded
+
+def download_snapshot(bucket, key, path):
+    """
+    Downloads the snapshot object from S3 and opens it
+    Parameters
+    ----------
+    bucket: string, required
+        S3 bucket name
+    key: string, required
+        S3 object key of the snapshot
+    path: string, required
+        Local path to store the snapshot at, usually under /tmp
+    Returns
+    -------
+    MembershipSnapshot
+        The opened snapshot
+    """
+    # Download next to the target and rename, so that a snapshot which is still mapped is never overwritten in place
+    download_path = f"{path}.download"
+    s3_client.download_file(bucket, key, download_path)
+    os.replace(download_path, path)
+    snapshot = MembershipSnapshot(path)
+    logger.info(f"Loaded membership snapshot s3://{bucket}/{key} with {len(snapshot)} entries")
+    return snapshot
+
+def upload_snapshot(bucket, key, keys):
+    """
+    Builds the snapshot for the given keys and stores it in S3
+    Parameters
+    ----------
+    bucket: string, required
+        S3 bucket name
+    key: string, required
+        S3 object key of the snapshot
+    keys: iterable, required
+        Strings to store in the snapshot
+    Returns
+    -------
+    int
+        Size of the uploaded snapshot in bytes
+    """
+    content = build_snapshot(keys)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=content, ContentType='application/octet-stream')
+    return len(content)
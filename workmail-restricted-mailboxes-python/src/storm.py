@@ -0,0 +1,107 @@
+import boto3
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+class LocalCounterStore:
+    """
+    In-memory stand-in for DynamoDBCounterStore. Counts are only shared by invocations of the same Lambda container,
+    which makes it useful for local testing and benchmarking.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def increment(self, address, window_start, expires_at):
+        with self._lock:
+            count = self._counts.get((address, window_start), 0) + 1
+            self._counts[(address, window_start)] = count
+            return count
+
+    def get(self, address, window_start):
+        with self._lock:
+            return self._counts.get((address, window_start), 0)
+
+class DynamoDBCounterStore:
+    """
+    Per-window message counters shared by all Lambda containers, stored as atomic counters in a DynamoDB table with
+    partition key Address (string), sort key WindowStart (number) and TTL attribute TimeToLive.
+    """
+
+    def __init__(self, table_name, dynamodb=None):
+        self.table = (dynamodb or boto3.resource('dynamodb')).Table(table_name)
+
+    def increment(self, address, window_start, expires_at):
+        response = self.table.update_item(
+            Key={'Address': address, 'WindowStart': window_start},
+            UpdateExpression='ADD MessageCount :one SET TimeToLive = :ttl',
+            ExpressionAttributeValues={':one': 1, ':ttl': expires_at},
+            ReturnValues='UPDATED_NEW',
+        )
+        return int(response['Attributes']['MessageCount'])
+
+    def get(self, address, window_start):
+        response = self.table.get_item(Key={'Address': address, 'WindowStart': window_start})
+        return int(response.get('Item', {}).get('MessageCount', 0))
+
+class StormGuard:
+    """
+    Detects mail storms to protected addresses with a sliding window counter.
+
+    Every message to a protected address costs one atomic increment of the counter of the current window. The count
+    of the previous window is read once per window and container, and weighted by how much of it still overlaps the
+    sliding window. Once an address is in a storm, it is held in that state for a full window by this container, so
+    that the protection does not flap on and off while the storm is still going.
+    """
+
+    def __init__(self, protected_addresses, threshold, window_seconds=60, store=None, clock=time.time):
+        self.protected_addresses = frozenset(address.strip().lower() for address in protected_addresses if address.strip())
+        self.threshold = threshold
+        self.window_seconds = window_seconds
+        self.store = store or LocalCounterStore()
+        self.clock = clock
+        self._previous_counts = {}  # (address, window_start) -> count
+        self._storms = {}           # address -> time until which it is held in storm state
+
+    def check(self, recipients):
+        """
+        Counts a message to the given recipients and returns the ones that are in a mail storm
+        Parameters
+        ----------
+        recipients: list, required
+            A list of recipient email addresses
+        Returns
+        -------
+        list
+            A list of recipient email addresses that are protected and receive more than threshold messages per window
+        """
+        now = self.clock()
+        window_start = int(now // self.window_seconds) * self.window_seconds
+        overlap = 1 - (now - window_start) / self.window_seconds
+        in_storm = []
+        for recipient in recipients:
+            address = recipient.lower()
+            if address not in self.protected_addresses:
+                continue
+            # Always count the message, also while bouncing, otherwise the storm would clear while it is still going
+            count = self.store.increment(address, window_start, window_start + 2 * self.window_seconds)
+            if self._storms.get(address, 0) > now:
+                in_storm.append(recipient)
+                continue
+            estimate = count + self._previous_count(address, window_start - self.window_seconds) * overlap
+            if estimate > self.threshold:
+                logger.info(f"Mail storm detected for {address}: {estimate:.0f} messages in the last {self.window_seconds} seconds")
+                self._storms[address] = now + self.window_seconds
+                in_storm.append(recipient)
+        return in_storm
+
+    def _previous_count(self, address, window_start):
+        key = (address, window_start)
+        if key not in self._previous_counts:
+            # The previous window is complete, so its count only has to be read once
+            self._previous_counts = {k: v for k, v in self._previous_counts.items() if k[1] >= window_start}
+            self._previous_counts[key] = self.store.get(address, window_start)
+        return self._previous_counts[key]
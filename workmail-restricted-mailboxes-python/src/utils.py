@@ -1,28 +1,48 @@
 import boto3
 import os
 import logging
+import snapshot
+from domains import DomainIndex
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
 
 logger = logging.getLogger()
 workmail_client = boto3.client('workmail')
 
-def get_members_of_group(organization_id, group_name):
+# Group ids, group members and allowed domains are cached across warm invocations, so that the steady
+# state cost per message is in-memory set lookups instead of WorkMail control plane calls
+CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', 300))
+CACHE_STALE_SECONDS = int(os.getenv('CACHE_STALE_SECONDS', CACHE_TTL_SECONDS))
+cache = TTLCache(CACHE_TTL_SECONDS, CACHE_STALE_SECONDS)
+# Email addresses and aliases of users are cached per user and longer, as listing aliases takes a call per user.
+# Group membership is not part of these entries, it is cached for CACHE_TTL_SECONDS like the other entries
+ADDRESS_CACHE_TTL_SECONDS = int(os.getenv('ADDRESS_CACHE_TTL_SECONDS', 3600))
+ADDRESS_CACHE_MAX_USERS = 100000
+address_cache = TTLCache(ADDRESS_CACHE_TTL_SECONDS, CACHE_STALE_SECONDS, max_entries=ADDRESS_CACHE_MAX_USERS)
+
+# Optional precomputed membership snapshot, see membership_snapshot_handler in app.py
+SNAPSHOT_S3_BUCKET = os.getenv('SNAPSHOT_S3_BUCKET')
+SNAPSHOT_S3_KEY = os.getenv('SNAPSHOT_S3_KEY', 'restricted-membership.snapshot')
+SNAPSHOT_LOCAL_PATH = '/tmp/restricted-membership.snapshot'
+
+# Additional comma separated domains categorized as internal, "*.example.test" matches any subdomain of example.test
+ALLOWED_DOMAINS = [domain for domain in os.getenv('ALLOWED_DOMAINS', '').split(',') if domain.strip()]
+
+# Number of sibling groups listed concurrently while expanding nested groups
+GROUP_EXPANSION_WORKERS = int(os.getenv('GROUP_EXPANSION_WORKERS', 8))
+
+def get_membership_snapshot():
     """
-    Returns group member names for a group with given group_name
-    Parameters
-    ----------
-    organization_id: string, required
-        Amazon WorkMail organization id
-    group_name: string, requred
-        Amazon Workmail group name
+    Returns the precomputed membership snapshot of RESTRICTED_GROUP_NAME from SNAPSHOT_S3_BUCKET. Result is cached for CACHE_TTL_SECONDS
     Returns
     -------
-    list
-        A list of string containing group member names
-    Raises
-    ------
-    Exception:
-        When workmail group with given group_name was not found
+    snapshot.MembershipSnapshot
+        A set-like container of the lowercase email addresses and aliases of the group members
     """
+    return cache.get(('snapshot', SNAPSHOT_S3_BUCKET, SNAPSHOT_S3_KEY),
+                     lambda: snapshot.download_snapshot(SNAPSHOT_S3_BUCKET, SNAPSHOT_S3_KEY, SNAPSHOT_LOCAL_PATH))
+
+def _load_group_id(organization_id, group_name):
     group_id = None
     for group in workmail_client.list_groups(OrganizationId=organization_id)['Groups']:
         if group['Name'] == group_name:
@@ -30,63 +50,192 @@ def get_members_of_group(organization_id, group_name):
 
     if group_id is None:
         raise Exception(f"WorkMail group:{group_name} not found")
+    return group_id
 
-    all_members = workmail_client.list_group_members(OrganizationId=organization_id, GroupId=group_id)['Members']
-    member_names = [member['Name'].lower() for member in all_members]
-    return member_names
+def _list_direct_members(organization_id, group_id):
+    """
+    Returns direct members of a group as a tuple of (id, name, type), cached across invocations
+    """
+    def load():
+        paginator = workmail_client.get_paginator('list_group_members')
+        return tuple((member['Id'], member['Name'].lower(), member['Type'])
+                     for page in paginator.paginate(OrganizationId=organization_id, GroupId=group_id)
+                     for member in page['Members'])
+    return cache.get(('direct_members', organization_id, group_id), load)
 
-def filter_external(email_addresses, organization_id):
+def expand_group(organization_id, group_id):
     """
-    Returns filtered list of email addresses that are external for a given organization
+    Returns all users of a group, including users of nested groups
+    Nested groups are expanded level by level; sibling groups are listed concurrently, each group is listed at most
+    once per expansion, and cycles between groups are skipped
     Parameters
     ----------
-    email_addresses: list, required
-        A list of email addresses
     organization_id: string, required
         Amazon WorkMail organization id
+    group_id: string, requred
+        Amazon Workmail group id
     Returns
     -------
-    list
-        A list of email addresses that were external for the given organization
+    dict
+        A dict of user id to lowercase user name
     """
-    external_email_addresses = []
-    default_domain =  workmail_client.describe_organization(OrganizationId=organization_id)['DefaultMailDomain']
-    allowed_domains = [ default_domain,
-            # "mydomain.test",  Tip: You can add additional domains into this list to enable sending/receiving emails from them
-            ]
+    users = {}
+    visited = {group_id}
+    level = [group_id]
+    with ThreadPoolExecutor(max_workers=GROUP_EXPANSION_WORKERS) as executor:
+        while level:
+            next_level = []
+            for members in executor.map(lambda gid: _list_direct_members(organization_id, gid), level):
+                for member_id, member_name, member_type in members:
+                    if member_type == 'GROUP':
+                        if member_id not in visited:
+                            visited.add(member_id)
+                            next_level.append(member_id)
+                    else:
+                        users[member_id] = member_name
+            level = next_level
+    return users
 
-    for email_address in email_addresses:
-        # Extract domain part of email address
-        domain = email_address['address'].lower().split('@')[1]
-        if domain not in allowed_domains:
-            external_email_addresses.append(email_address['address'])
-    return external_email_addresses
+def get_restricted_entity_ids(organization_id, group_name):
+    """
+    Returns entity ids of all users of a group with given group_name, including nested groups. Result is cached for CACHE_TTL_SECONDS
+    Parameters
+    ----------
+    organization_id: string, required
+        Amazon WorkMail organization id
+    group_name: string, requred
+        Amazon Workmail group name
+    Returns
+    -------
+    frozenset
+        A set of WorkMail entity ids
+    """
+    group_id = cache.get(('group_id', organization_id, group_name),
+                         lambda: _load_group_id(organization_id, group_name))
+    return cache.get(('group_entity_ids', organization_id, group_id),
+                     lambda: frozenset(expand_group(organization_id, group_id)))
 
-def filter_restricted(email_addresses, organization_id, group_name):
+def get_address_masks(organization_id, group_names):
     """
-    Returns filtered list of email addresses that are restricted to send/recieve external emails
+    Returns a mapping of every email address and alias of the given groups' users to a bitmask of the groups they
+    belong to, where bit i stands for group_names[i]. Result is cached for CACHE_TTL_SECONDS
+    Parameters
+    ----------
+    organization_id: string, required
+        Amazon WorkMail organization id
+    group_names: tuple, required
+        Amazon Workmail group names, None entries are skipped
+    Returns
+    -------
+    dict
+        A dict of lowercase email address to group bitmask, addresses that belong to none of the groups are omitted
+    """
+    def load():
+        address_masks = {}
+        for bit, group_name in enumerate(group_names):
+            if group_name is None:
+                continue
+            for address in get_group_addresses(organization_id, group_name):
+                address_masks[address] = address_masks.get(address, 0) | (1 << bit)
+        return address_masks
+    return cache.get(('address_masks', organization_id, tuple(group_names)), load)
+
+def get_group_addresses(organization_id, group_name):
+    """
+    Returns an index of the email addresses and aliases of all users of a group with given group_name, including
+    nested groups. Membership is cached for CACHE_TTL_SECONDS, the addresses of every user for ADDRESS_CACHE_TTL_SECONDS,
+    as aliases change rarely and take a WorkMail call per user to list
+    Parameters
+    ----------
+    organization_id: string, required
+        Amazon WorkMail organization id
+    group_name: string, requred
+        Amazon Workmail group name
+    Returns
+    -------
+    dict
+        A dict of lowercase email address to WorkMail user id
+    """
+    user_ids = get_restricted_entity_ids(organization_id, group_name)
+    addresses = address_cache.get_many(
+        [('user_addresses', organization_id, user_id) for user_id in user_ids],
+        lambda keys: {('user_addresses', organization_id, user_id): user_addresses
+                      for user_id, user_addresses in _load_user_addresses(organization_id, [key[2] for key in keys]).items()})
+    return {address: key[2] for key, user_addresses in addresses.items() for address in user_addresses}
+
+def _load_user_addresses(organization_id, user_ids):
+    """
+    Returns a dict of every given user id to a tuple of the user's lowercase email address and aliases, empty for
+    users that are not enabled. Email addresses are taken from the list_users pages, aliases are listed concurrently
+    for the given users only
+    """
+    user_ids = set(user_ids)
+    emails = {}
+    for page in workmail_client.get_paginator('list_users').paginate(OrganizationId=organization_id):
+        for user in page['Users']:
+            if user['Id'] in user_ids and user.get('State') == 'ENABLED' and user.get('Email'):
+                emails[user['Id']] = user['Email']
+
+    def list_aliases(user_id):
+        paginator = workmail_client.get_paginator('list_aliases')
+        return [alias for page in paginator.paginate(OrganizationId=organization_id, EntityId=user_id)
+                for alias in page['Aliases']]
+
+    addresses = dict.fromkeys(user_ids, ())
+    with ThreadPoolExecutor(max_workers=GROUP_EXPANSION_WORKERS) as executor:
+        for (user_id, email), aliases in zip(emails.items(), executor.map(list_aliases, emails)):
+            addresses[user_id] = tuple(dict.fromkeys([email.lower()] + [alias.lower() for alias in aliases]))
+    logger.info(f"Listed the addresses of {len(emails)} users")
+    return addresses
+
+def get_member_addresses(organization_id, group_name):
+    """
+    Returns email addresses and aliases of all users of a group with given group_name, including nested groups
     Parameters
     ----------
-    email_addresses: list, required
-        A list of email addresses
     organization_id: string, required
         Amazon WorkMail organization id
     group_name: string, requred
         Amazon Workmail group name
     Returns
     -------
-    list
-        A list of email addresses that are restricted to send/receive external emails
-    """
-    restricted_email_addresses = []
-    group_members = get_members_of_group(organization_id, group_name)
-    for email_address in email_addresses:
-        # Extract username a.k.a local-part of email address
-        username = email_address['address'].lower().split('@')[0]
-        if username in group_members:
-            restricted_email_addresses.append(email_address['address'])
-
-    return restricted_email_addresses
+    set
+        A set of lowercase email addresses and aliases
+    """
+    group_id = _load_group_id(organization_id, group_name)
+    users = expand_group(organization_id, group_id)
+    addresses = set()
+    for user_addresses in _load_user_addresses(organization_id, users).values():
+        addresses.update(user_addresses)
+    return addresses
+
+def get_allowed_domains(organization_id):
+    """
+    Returns domains that are categorized as internal for a given organization: all mail domains of the organization
+    and ALLOWED_DOMAINS. Result is cached for CACHE_TTL_SECONDS
+    Parameters
+    ----------
+    organization_id: string, required
+        Amazon WorkMail organization id
+    Returns
+    -------
+    DomainIndex
+        A set-like container of domain names
+    """
+    return cache.get(('allowed_domains', organization_id), lambda: _load_allowed_domains(organization_id))
+
+def _load_allowed_domains(organization_id):
+    allowed_domains = [ *ALLOWED_DOMAINS,
+            # "mydomain.test",  Tip: You can add additional domains into this list to enable sending/receiving emails from them
+            ]
+    args = {'OrganizationId': organization_id}
+    while True:
+        response = workmail_client.list_mail_domains(**args)
+        allowed_domains.extend(mail_domain['DomainName'] for mail_domain in response['MailDomains'])
+        if 'NextToken' not in response:
+            break
+        args['NextToken'] = response['NextToken']
+    return DomainIndex(allowed_domains)
 
 def get_env_var(name):
     """
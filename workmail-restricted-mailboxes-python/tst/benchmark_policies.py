@@ -0,0 +1,52 @@
+"""
+Measures policy evaluation time for envelopes with thousands of recipients, without calling WorkMail.
+
+    python tst/benchmark_policies.py
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['RESTRICTED_GROUP_NAME'] = 'Restricted'
+os.environ['POLICIES'] = '''[
+    { "group": "Restricted", "type": "NO_EXTERNAL_INBOUND" },
+    { "group": "Restricted", "type": "NO_EXTERNAL_OUTBOUND" },
+    { "group": "Contractors", "type": "INTERNAL_ONLY", "domains": ["partner.test", "*.customer.test"] }
+]'''
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import policies  # noqa: E402
+import utils  # noqa: E402
+from domains import DomainIndex  # noqa: E402
+
+MEMBERS = 20000
+ITERATIONS = 20
+
+# The organization data is served from the container cache in steady state, so stub the cached lookups
+address_masks = {}
+for i in range(MEMBERS):
+    address_masks[f"user{i}@example.test"] = 1 if i % 3 else 2
+utils.get_allowed_domains = lambda organization_id: DomainIndex(['example.test', 'example2.test'])
+utils.get_address_masks = lambda organization_id, group_names: address_masks
+
+def envelope(direction, sender, recipient_count):
+    domains = ['example.test', 'external.test', 'partner.test', 'a.customer.test']
+    return {
+        'flowDirection': direction,
+        'envelope': {
+            'mailFrom': { 'address': sender },
+            'recipients': [{ 'address': f"user{i}@{domains[i % len(domains)]}" } for i in range(recipient_count)],
+        },
+    }
+
+engine = policies.PolicyEngine(policies.load_policies())
+for recipient_count in (100, 1000, 10000):
+    for direction, sender in (('INBOUND', 'someone@external.test'), ('OUTBOUND', 'user3@example.test')):
+        summary = envelope(direction, sender, recipient_count)
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            response = engine.evaluate(summary, 'm-00000000000000000000000000000000')
+        elapsed = (time.perf_counter() - start) / ITERATIONS
+        print(f"{direction:8} {recipient_count:6} recipients: {elapsed * 1000:8.3f} ms/message, "
+              f"{elapsed / recipient_count * 1e6:6.3f} us/recipient, {len(response['actions'])} actions")
@@ -4,6 +4,7 @@ import email_utils
 import sf_utils
 from email.message import Message
 from botocore.exceptions import ClientError
+from simple_salesforce.exceptions import SalesforceAuthenticationFailed
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -31,7 +32,7 @@ def salesforce_handler(event, context):
     logger.info(f"Received email with message ID {message_id}, flowDirection {flow_direction}, from {from_address}")
 
     try:
-        sf_client = sf_utils.create_sf_client()
+        sf_client = sf_utils.sf_client_cache.get()
         # 1. Download and parse the email using messageId
         parsed_email: Message = email_utils.download_email(message_id)
         # 2. Process the parsed email message in Salesforce
@@ -50,6 +51,10 @@ def salesforce_handler(event, context):
             
             email_utils.update_workmail(message_id, parsed_email)
 
+    except SalesforceAuthenticationFailed as e:
+        # The credentials may have been rotated, read them again in the next invocation
+        sf_utils.sf_client_cache.invalidate()
+        raise(e)
     except ClientError as e:
         if e.response['Error']['Code'] == 'MessageFrozen':
             # Redirect emails are not eligible for update, handle it gracefully.
@@ -0,0 +1,85 @@
+import urllib.parse
+
+class CompositeRequestError(Exception):
+    """
+    Raised when a subrequest of a composite request fails
+    """
+
+class CompositeRequest:
+    """
+    Builds a request to the Salesforce Composite API, which runs up to 25 subrequests in one round trip. Later
+    subrequests can use the results of earlier ones with references, e.g. reference('NewAccount') for the Id of the
+    record created by the subrequest 'NewAccount'. With all_or_none, all subrequests are rolled back when one fails.
+    For more information, see https://developer.salesforce.com/docs/atlas.en-us.api_rest.meta/api_rest/resources_composite_composite.htm
+    """
+
+    def __init__(self, sf_client, all_or_none=True):
+        self.sf_client = sf_client
+        self.all_or_none = all_or_none
+        self.subrequests = []
+
+    def query(self, reference_id, soql):
+        # references in the query are resolved by Salesforce, so their characters are not encoded
+        self.subrequests.append({
+            'method': 'GET',
+            'url': f"/services/data/v{self.sf_client.sf_version}/query/?q={urllib.parse.quote(soql, safe='@{}[]')}",
+            'referenceId': reference_id,
+        })
+
+    def create(self, reference_id, sobject, record):
+        self.subrequests.append({
+            'method': 'POST',
+            'url': f"/services/data/v{self.sf_client.sf_version}/sobjects/{sobject}",
+            'referenceId': reference_id,
+            'body': record,
+        })
+
+    @staticmethod
+    def reference(reference_id, field='id'):
+        """
+        Returns a reference to a field of the result of an earlier subrequest, e.g. 'records[0].Id' for a query
+        """
+        return f"@{{{reference_id}.{field}}}"
+
+    def send(self):
+        """
+        Sends the subrequests in one request
+
+        Returns
+        -------
+        dict
+            The response body of every subrequest by reference id, None for failed subrequests without all_or_none
+        Raises
+        ------
+        CompositeRequestError:
+            When a subrequest fails and all_or_none is set
+        simple_salesforce.exceptions.SalesforceError:
+            When the composite request itself fails
+        """
+        response = self.sf_client.restful('composite', method='POST', json={
+            'allOrNone': self.all_or_none,
+            'compositeRequest': self.subrequests,
+        })
+        failed = [subresponse for subresponse in response['compositeResponse'] if subresponse['httpStatusCode'] >= 300]
+        if failed and self.all_or_none:
+            # the other subrequests only report that they were rolled back
+            causes = [subresponse for subresponse in failed if subresponse['body'][0].get('errorCode') != 'PROCESSING_HALTED']
+            raise CompositeRequestError('; '.join(f"Subrequest {subresponse['referenceId']} failed: {subresponse['body']}"
+                                                  for subresponse in causes or failed))
+        return {subresponse['referenceId']: None if subresponse in failed else subresponse['body']
+                for subresponse in response['compositeResponse']}
+
+def first_record(result, field):
+    """
+    Returns field of the first record of a query result, or None when there are no records
+
+    Raises
+    ------
+    CompositeRequestError:
+        When the query failed
+    """
+    if result is None:
+        raise CompositeRequestError("Query failed")
+    if result['records']:
+        return result['records'][0][field]
+    return None
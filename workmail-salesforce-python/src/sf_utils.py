@@ -4,10 +4,13 @@ import json
 import os
 import email_utils
 import icalendar
+import sf_composite
 import secrets
 import string
+import time
 import dateutil.parser
 from simple_salesforce import Salesforce
+from simple_salesforce.exceptions import SalesforceError
 from dateutil.relativedelta import relativedelta
 from icalendar import Calendar
 from dataclasses import dataclass
@@ -15,6 +18,10 @@ from dataclasses import dataclass
 secrets_manager = boto3.client('secretsmanager')
 # Salesforce requires a ClosedDate while creating a new opportunity, by default we set it to 1 month from the date of creation
 default_case_duration = relativedelta(months=1)
+# The Salesforce client of a Lambda container is recreated after this many seconds, which picks up rotated credentials
+sf_client_max_age_seconds = int(os.getenv('SF_CLIENT_MAX_AGE_SECONDS', 3600))
+# Emails are recorded with the Composite API in two round trips, falling back to one request per lookup and record
+use_composite_api = os.getenv('SF_USE_COMPOSITE_API', 'true').lower() == 'true'
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -39,9 +46,42 @@ def create_sf_client():
         raise ValueError("SF_SECRET_NAME not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it")
     response = secrets_manager.get_secret_value(SecretId=secret_name)
     secret = json.loads(response['SecretString'])
+    if secret.get('private_key'):
+        # OAuth 2.0 JWT bearer flow, with the private key of the certificate uploaded to the connected app
+        return Salesforce(username=secret['username'], consumer_key=secret['consumer_key'], privatekey=secret['private_key'])
     return Salesforce(username=secret['username'], password=secret['password'], security_token=secret['token'])
 
-def process_contact_and_account_id(sf_client, parsed_email, event, from_address):
+class SalesforceClientCache:
+    """
+    Keeps the Salesforce client, with its session id and open connections, for all invocations of a Lambda container,
+    instead of reading the secret and logging in to Salesforce for every email. When Salesforce answers
+    INVALID_SESSION_ID, e.g. after the session timed out, simple_salesforce logs in again and retries the call.
+    """
+
+    def __init__(self, max_age_seconds, clock=time.monotonic):
+        self.max_age_seconds = max_age_seconds
+        self.clock = clock
+        self.client = None
+        self.created_at = None
+
+    def get(self):
+        """
+        Returns the cached client, or a new one when there is none or it is older than max_age_seconds
+        """
+        if self.client is None or self.clock() - self.created_at >= self.max_age_seconds:
+            self.client = create_sf_client()
+            self.created_at = self.clock()
+        return self.client
+
+    def invalidate(self):
+        """
+        Drops the cached client, so that the next invocation reads the secret and logs in again
+        """
+        self.client = None
+
+sf_client_cache = SalesforceClientCache(sf_client_max_age_seconds)
+
+def get_contact_details(parsed_email, event, from_address):
     # Set the following fields depending on flow direction of email
     contact_address = None
     first_name = 'None'
@@ -56,6 +96,10 @@ def process_contact_and_account_id(sf_client, parsed_email, event, from_address)
         contact_address = event['envelope']['recipients'][0]['address']
         if parsed_email['To'] is not None:
             first_name, last_name = email_utils.extract_username(parsed_email['To'])
+    return contact_address, first_name, last_name
+
+def process_contact_and_account_id(sf_client, parsed_email, event, from_address):
+    contact_address, first_name, last_name = get_contact_details(parsed_email, event, from_address)
 
     # Fetch or create the contact and account in Salesforce
     contact_id = run_sf_query(sf_client, f"SELECT Id FROM Contact WHERE Email='{contact_address}'", 'Id')
@@ -76,6 +120,19 @@ def process_contact_and_account_id(sf_client, parsed_email, event, from_address)
     return contact_id, account_id
 
 def process_email(sf_client, parsed_email, event):
+    if use_composite_api:
+        try:
+            return process_email_composite(sf_client, parsed_email, event)
+        except (SalesforceError, sf_composite.CompositeRequestError) as e:
+            # Nothing was created, as the records are created all or none
+            logger.warning(f"Composite request failed, falling back to sequential requests: {e}")
+    return process_email_sequentially(sf_client, parsed_email, event)
+
+def new_case_id():
+    # Generate a new 8 digit alphanumeric caseId
+    return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for i in range(8))
+
+def process_email_sequentially(sf_client, parsed_email, event):
     from_address = event['envelope']['mailFrom']['address']
     contact_id, account_id = process_contact_and_account_id(sf_client, parsed_email, event, from_address)
     # Fetch or create Salesforce opportunity
@@ -85,8 +142,7 @@ def process_email(sf_client, parsed_email, event):
     opportunity_id = None
     is_new_case = False
     if case_id is None:
-        # Generate a new 8 digit alphanumeric caseId
-        case_id = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for i in range(8))
+        case_id = new_case_id()
         is_new_case = True
         subject = f"[CaseId:{case_id}] {subject}"
         logger.info(f"Could not find exisiting case, generated new CaseId: {case_id}")
@@ -111,6 +167,75 @@ def process_email(sf_client, parsed_email, event):
     logger.info(f"Associated email with Opportunity!")
     return SalesforceCase(account_id, opportunity_id, contact_id, case_id, is_new_case)
 
+def process_email_composite(sf_client, parsed_email, event):
+    """
+    Records the email like process_email_sequentially, in two composite requests instead of up to nine requests: one
+    looks up the contact with its account, the opportunity of the case and the contact role, the other creates the
+    missing records and the email, referencing each other, all or none.
+    """
+    from_address = event['envelope']['mailFrom']['address']
+    contact_address, first_name, last_name = get_contact_details(parsed_email, event, from_address)
+    subject = event['subject'] if event['subject'] is not None else ''
+    date = parsed_email['Date']
+    case_id = email_utils.extract_case_id(subject)
+    is_new_case = False
+    if case_id is None:
+        case_id = new_case_id()
+        is_new_case = True
+        subject = f"[CaseId:{case_id}] {subject}"
+        logger.info(f"Could not find exisiting case, generated new CaseId: {case_id}")
+
+    # 1. Look up the existing records. The contact role query references the contact, it fails when there is none
+    lookups = sf_composite.CompositeRequest(sf_client, all_or_none=False)
+    lookups.query('Contact', f"SELECT Id, AccountId FROM Contact WHERE Email='{contact_address}'")
+    lookups.query('ContactRole', f"SELECT Id FROM OpportunityContactRole WHERE ContactId='{lookups.reference('Contact', 'records[0].Id')}'")
+    if not is_new_case:
+        lookups.query('Opportunity', f"SELECT Id FROM Opportunity WHERE TrackingNumber__c='{case_id}'")
+    found = lookups.send()
+
+    contact_id = sf_composite.first_record(found['Contact'], 'Id')
+    account_id = sf_composite.first_record(found['Contact'], 'AccountId')
+    contact_role_id = sf_composite.first_record(found['ContactRole'], 'Id') if contact_id is not None else None
+    opportunity_id = sf_composite.first_record(found['Opportunity'], 'Id') if not is_new_case else None
+
+    # 2. Create the missing records and the email
+    records = sf_composite.CompositeRequest(sf_client)
+    account_ref = account_id
+    if account_id is None:
+        records.create('Account', 'Account', {'Name': contact_address.lower().split('@')[1]})
+        account_ref = records.reference('Account')
+    contact_ref = contact_id
+    if contact_id is None:
+        records.create('Contact', 'Contact', {'LastName': last_name, 'FirstName': first_name, 'Email': contact_address, 'AccountId': account_ref})
+        contact_ref = records.reference('Contact')
+    opportunity_ref = opportunity_id
+    if opportunity_id is None:
+        close_date = dateutil.parser.parse(date) + default_case_duration
+        records.create('Opportunity', 'Opportunity', {'Name':subject, 'StageName':'Qualification', 'TrackingNumber__c':case_id , 'AccountId':account_ref, 'CloseDate':close_date.strftime('%Y-%m-%d')})
+        opportunity_ref = records.reference('Opportunity')
+    else:
+        logger.info(f"CaseId: {case_id} is already related to Opportunity: {opportunity_id}")
+    # Associate contact with opportunity if they aren't associated already
+    if contact_role_id is None:
+        records.create('ContactRole', 'OpportunityContactRole', {'ContactId':contact_ref, 'OpportunityId': opportunity_ref})
+
+    contents = email_utils.extract_text_body(parsed_email)
+    is_incoming_email = True if event['flowDirection'] == 'INBOUND' else False
+    records.create('EmailMessage', 'EmailMessage', {'RelatedToId': opportunity_ref, 'Subject': subject, 'TextBody': contents, 'FromAddress': from_address, 'MessageDate': date, 'Incoming': is_incoming_email, 'ToAddress': event['envelope']['recipients'][0]['address']})
+    created = records.send()
+
+    if account_id is None:
+        account_id = created['Account']['id']
+        logger.info(f"Created a new account for {contact_address} with AccountId: {account_id}")
+    if contact_id is None:
+        contact_id = created['Contact']['id']
+        logger.info(f"Created a new contact for {contact_address} with ContactId: {contact_id}")
+    if opportunity_id is None:
+        opportunity_id = created['Opportunity']['id']
+        logger.info(f"Opportunity: {opportunity_id} created for CaseId: {case_id}")
+    logger.info("Associated email with Opportunity!")
+    return SalesforceCase(account_id, opportunity_id, contact_id, case_id, is_new_case)
+
 def process_meeting_request(sf_client, cal_body, sf_case):
     meeting = parse_calendar_item(cal_body)
     meeting['ID'] = run_sf_query(sf_client, f"SELECT id FROM Event WHERE Subject LIKE '[CaseId:{sf_case.case_id}]%'", 'Id')
@@ -0,0 +1,137 @@
+"""
+Compares recording emails in Salesforce with one request per lookup and record (process_email_sequentially) and with
+the Composite API (process_email_composite), against an in-process stand-in for Salesforce that takes
+ROUND_TRIP_SECONDS per request and SUBREQUEST_SECONDS per lookup or record. Both are run for emails from new senders
+with a new case, and from known senders replying to an existing case.
+
+    python tst/benchmark_composite.py
+"""
+import copy
+import email
+import itertools
+import os
+import re
+import sys
+import time
+import urllib.parse
+from email.message import EmailMessage
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import sf_utils  # noqa: E402
+
+EMAILS = 20
+# a request from a Lambda function to a Salesforce instance in another region
+ROUND_TRIP_SECONDS = 0.06
+SUBREQUEST_SECONDS = 0.005
+
+QUERY = re.compile(r"SELECT (?P<fields>.+) FROM (?P<sobject>\w+) WHERE (?P<field>\w+)='(?P<value>[^']*)'")
+REFERENCE = re.compile(r"@\{(\w+)\.([^}]+)\}")
+
+class SalesforceStandIn:
+    sf_version = '59.0'
+
+    def __init__(self):
+        self.records = {}
+        self.ids = itertools.count(1)
+        self.round_trips = 0
+
+    def query(self, soql):
+        self.round_trips += 1
+        time.sleep(ROUND_TRIP_SECONDS + SUBREQUEST_SECONDS)
+        return self._query(soql)
+
+    def __getattr__(self, sobject):
+        stand_in = self
+
+        class SObject:
+            def create(self, record):
+                stand_in.round_trips += 1
+                time.sleep(ROUND_TRIP_SECONDS + SUBREQUEST_SECONDS)
+                return stand_in._create(sobject, record)
+        return SObject()
+
+    def restful(self, path, method='GET', json=None):
+        assert path == 'composite' and method == 'POST'
+        self.round_trips += 1
+        time.sleep(ROUND_TRIP_SECONDS + SUBREQUEST_SECONDS * len(json['compositeRequest']))
+        snapshot = copy.deepcopy(self.records)
+        results = {}
+        responses = []
+        for subrequest in json['compositeRequest']:
+            try:
+                url = self._resolve(subrequest['url'], results)
+                if subrequest['method'] == 'GET':
+                    body = self._query(urllib.parse.unquote(url.split('?q=', 1)[1]))
+                    status = 200
+                else:
+                    record = {key: self._resolve(value, results) for key, value in subrequest['body'].items()}
+                    body = self._create(url.rsplit('/', 1)[1], record)
+                    status = 201
+            except LookupError as e:
+                body, status = [{'errorCode': 'INVALID_REFERENCE', 'message': str(e)}], 400
+            results[subrequest['referenceId']] = body
+            responses.append({'referenceId': subrequest['referenceId'], 'httpStatusCode': status, 'body': body})
+        if json['allOrNone'] and any(response['httpStatusCode'] >= 300 for response in responses):
+            self.records = snapshot
+            for response in responses:
+                if response['httpStatusCode'] < 300:
+                    response.update(httpStatusCode=400, body=[{'errorCode': 'PROCESSING_HALTED'}])
+        return {'compositeResponse': responses}
+
+    def _query(self, soql):
+        match = QUERY.fullmatch(soql)
+        fields = [field.strip() for field in match['fields'].split(',')]
+        records = [record for record in self.records.get(match['sobject'], []) if record.get(match['field']) == match['value']]
+        return {'totalSize': len(records), 'records': [{field: record.get(field) for field in fields} for record in records]}
+
+    def _create(self, sobject, record):
+        record = dict(record, Id=f"{sobject[:3]}{next(self.ids):012d}")
+        self.records.setdefault(sobject, []).append(record)
+        return {'id': record['Id'], 'success': True, 'errors': []}
+
+    @staticmethod
+    def _resolve(value, results):
+        def replace(match):
+            result = results[match[1]]
+            for step in re.findall(r"\w+|\[\d+\]", match[2]):
+                result = result[int(step[1:-1])] if step.startswith('[') else result[step]
+            return result
+        return REFERENCE.sub(replace, value) if isinstance(value, str) else value
+
+def email_and_event(sender, subject):
+    message = EmailMessage()
+    message['From'] = f"Jane Doe <{sender}>"
+    message['To'] = 'Support <support@example.test>'
+    message['Subject'] = subject
+    message['Date'] = 'Mon, 19 Oct 2026 10:00:00 +0000'
+    message.set_content('Hello')
+    event = {
+        'flowDirection': 'INBOUND',
+        'subject': subject,
+        'envelope': {'mailFrom': {'address': sender}, 'recipients': [{'address': 'support@example.test'}]},
+    }
+    return email.message_from_bytes(message.as_bytes()), event
+
+def run(name, process_email):
+    sf_client = SalesforceStandIn()
+    for scenario in ('new sender and case', 'known sender and case'):
+        sf_client.round_trips = 0
+        start = time.perf_counter()
+        for i in range(EMAILS):
+            if scenario == 'new sender and case':
+                sf_case = process_email(sf_client, *email_and_event(f"customer{i}@example{i}.test", 'Question'))
+                case_ids[i] = sf_case.case_id
+            else:
+                process_email(sf_client, *email_and_event(f"customer{i}@example{i}.test", f"[CaseId:{case_ids[i]}] Re: Question"))
+        elapsed = time.perf_counter() - start
+        print(f"{name:10} {scenario:22}: {sf_client.round_trips / EMAILS:4.1f} round trips, "
+              f"{elapsed / EMAILS * 1000:6.1f} ms per email")
+    return {sobject: len(records) for sobject, records in sf_client.records.items()}
+
+case_ids = {}
+sequential = run('sequential', sf_utils.process_email_sequentially)
+composite = run('composite', sf_utils.process_email_composite)
+assert sequential == composite, (sequential, composite)
+print(f"records created by both: {composite}")
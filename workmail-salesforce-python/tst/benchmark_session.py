@@ -0,0 +1,51 @@
+"""
+Compares the time spent getting an authenticated Salesforce client per email, when logging in for every email
+(create_sf_client) and with the client cached for the Lambda container (sf_client_cache), against stand-ins for
+Secrets Manager and the Salesforce login that take SECRET_SECONDS and LOGIN_SECONDS.
+
+    python tst/benchmark_session.py
+"""
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('SF_SECRET_NAME', 'salesforce')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import sf_utils  # noqa: E402
+
+MESSAGES = 50
+SECRET_SECONDS = 0.03
+# a SOAP login typically takes a few hundred milliseconds
+LOGIN_SECONDS = 0.3
+
+class SecretsManagerStandIn:
+    calls = 0
+
+    def get_secret_value(self, SecretId):
+        SecretsManagerStandIn.calls += 1
+        time.sleep(SECRET_SECONDS)
+        return {'SecretString': json.dumps({'username': 'user', 'password': 'password', 'token': 'token'})}
+
+class SalesforceStandIn:
+    logins = 0
+
+    def __init__(self, **credentials):
+        SalesforceStandIn.logins += 1
+        time.sleep(LOGIN_SECONDS)
+
+def run(name, get_client):
+    SecretsManagerStandIn.calls = SalesforceStandIn.logins = 0
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        get_client()
+    elapsed = time.perf_counter() - start
+    print(f"{name:16}: {MESSAGES} emails, {elapsed / MESSAGES * 1000:6.1f} ms per email to get a client, "
+          f"{SecretsManagerStandIn.calls} secret reads, {SalesforceStandIn.logins} logins")
+
+sf_utils.secrets_manager = SecretsManagerStandIn()
+sf_utils.Salesforce = SalesforceStandIn
+run('login per email', sf_utils.create_sf_client)
+run('cached client', sf_utils.SalesforceClientCache(sf_utils.sf_client_max_age_seconds).get)
@@ -1,12 +1,20 @@
 import logging
 import os
 import boto3
-import email
-import re
+import metrics
+import rules
+from email.parser import BytesHeaderParser
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Rules are loaded and compiled once per Lambda container, see get_rule_engine
+rule_engine = None
+
+# Per-rule match counts, actions and evaluation times are emitted as CloudWatch Embedded Metric Format log lines,
+# aggregated over RULE_METRICS_FLUSH_SECONDS. Metrics that were not flushed yet are lost when the container shuts down
+rule_metrics = metrics.RuleMetrics(flush_seconds=float(os.getenv('RULE_METRICS_FLUSH_SECONDS', 60)))
+
 def upstream_gateway_handler(email_summary, context):
     """
     Upstream Gateway Filtering for Amazon WorkMail
@@ -86,49 +94,33 @@ def upstream_gateway_handler(email_summary, context):
     """
     logger.info(email_summary)
     
-    # get the environment variables containing the header name and regex to match
-    filter_header_name = os.getenv('FILTER_HEADER_NAME')
-    if not filter_header_name:
-        error_msg = 'FILTER_HEADER_NAME not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it.'
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-    filter_header_regex = os.getenv('FILTER_HEADER_REGEX')
-    if not filter_header_regex:
-        error_msg = 'FILTER_HEADER_REGEX not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it.'
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-    regexp = re.compile(filter_header_regex)
-
-    # get the value of the message header
-    workmail = boto3.client('workmailmessageflow')
-    msg_id = email_summary['messageId']
-    raw_msg = workmail.get_raw_message_content(messageId=msg_id)
-    parsed_msg = email.message_from_bytes(raw_msg['messageContent'].read())
-    filter_header_value = parsed_msg.get(filter_header_name)
+    engine = get_rule_engine()
 
     flow_direction = email_summary['flowDirection']
-    
-    if flow_direction == 'INBOUND' and filter_header_value:
-        logger.info(filter_header_name + ": " + filter_header_value)
-        if regexp.search(filter_header_value):
-            return {
-                'actions': [
-                    {
-                        'allRecipients': True,                  # For all recipients
-                        'action' : { 'type': 'MOVE_TO_JUNK' }
-                    }
-                ]
-            }
-        else:
+    if flow_direction == 'INBOUND':
+        # only the headers of the message are read and parsed, every occurrence of a header is evaluated
+        workmail = boto3.client('workmailmessageflow')
+        msg_id = email_summary['messageId']
+        raw_msg = workmail.get_raw_message_content(messageId=msg_id)
+        headers = BytesHeaderParser().parsebytes(read_headers(raw_msg['messageContent']))
+
+        rule = engine.evaluate(headers, rule_metrics)
+        rule_metrics.record_decision(rule, rule.action if rule else 'DEFAULT')
+        rule_metrics.flush()
+        if rule:
+            logger.info(f"Rule {rule.name} matched {rule.header}, action {rule.action}")
+            action = { 'type': rule.action }
+            if rule.parameters:
+                action['parameters'] = rule.parameters
             return {
                 'actions': [
                     {
                         'allRecipients': True,                  # For all recipients
-                        'action' : { 'type': 'BYPASS_SPAM_CHECK' }
+                        'action' : action
                     }
                 ]
             }
-                        
+
     logger.info("Default action. Nothing to do.")
     return {
         'actions': [
@@ -138,3 +130,28 @@ def upstream_gateway_handler(email_summary, context):
             }
         ]
     }
+
+def get_rule_engine():
+    """
+    Returns the rule engine, rules are loaded and compiled once per Lambda container
+    """
+    global rule_engine
+    if rule_engine is None:
+        rule_engine = rules.RuleEngine(rules.load_rules())
+    return rule_engine
+
+def read_headers(stream, chunk_size=4096, max_size=1048576):
+    """
+    Returns the header section of the raw message in stream, without reading its body
+    """
+    header = b''
+    for chunk in stream.iter_chunks(chunk_size):
+        header += chunk
+        end = min((i for i in (header.find(b'\r\n\r\n'), header.find(b'\n\n')) if i >= 0), default=-1)
+        if end >= 0:
+            header = header[:end]
+            break
+        if len(header) > max_size:
+            break
+    stream.close()
+    return header
@@ -0,0 +1,68 @@
+import json
+import time
+
+class RuleMetrics:
+    """
+    Aggregates per-rule, per-header and per-action metrics over several invocations, and emits them as CloudWatch
+    Embedded Metric Format log lines, one line per rule, header and action, at most every flush_seconds.
+
+    Rule lines carry the number of times the rule was searched (Evaluations), the number of messages it decided
+    (Matches), and the total and worst time spent searching it (EvaluationTime, MaxEvaluationTime, in milliseconds).
+    Header lines carry the time spent in the joined regex of the header (PrefilterTime), and action lines the number
+    of messages that got that action (Messages).
+    """
+
+    def __init__(self, namespace='WorkMail/UpstreamGatewayFilter', flush_seconds=60):
+        self.namespace = namespace
+        self.flush_seconds = flush_seconds
+        self.rules = {}
+        self.headers = {}
+        self.actions = {}
+        self.last_flush = time.monotonic()
+
+    def record_evaluation(self, rule, seconds):
+        stats = self.rules.setdefault(rule.name, {'Evaluations': 0, 'Matches': 0, 'EvaluationTime': 0.0, 'MaxEvaluationTime': 0.0})
+        milliseconds = seconds * 1000
+        stats['Evaluations'] += 1
+        stats['EvaluationTime'] += milliseconds
+        stats['MaxEvaluationTime'] = max(stats['MaxEvaluationTime'], milliseconds)
+
+    def record_prefilter(self, header, seconds):
+        stats = self.headers.setdefault(header, {'PrefilterSearches': 0, 'PrefilterTime': 0.0})
+        stats['PrefilterSearches'] += 1
+        stats['PrefilterTime'] += seconds * 1000
+
+    def record_decision(self, rule, action):
+        if rule is not None:
+            self.rules.setdefault(rule.name, {'Evaluations': 0, 'Matches': 0, 'EvaluationTime': 0.0, 'MaxEvaluationTime': 0.0})['Matches'] += 1
+        self.actions[action] = self.actions.get(action, 0) + 1
+
+    def flush(self, force=False):
+        """
+        Emits the aggregated metrics when flush_seconds have passed since the last flush, or when force is True
+        """
+        if not force and time.monotonic() - self.last_flush < self.flush_seconds:
+            return
+        for name, stats in self.rules.items():
+            self.emit('Rule', name, stats, {'EvaluationTime': 'Milliseconds', 'MaxEvaluationTime': 'Milliseconds'})
+        for header, stats in self.headers.items():
+            self.emit('Header', header, stats, {'PrefilterTime': 'Milliseconds'})
+        for action, count in self.actions.items():
+            self.emit('Action', action, {'Messages': count}, {})
+        self.rules, self.headers, self.actions = {}, {}, {}
+        self.last_flush = time.monotonic()
+
+    def emit(self, dimension, value, stats, units):
+        # Embedded Metric Format has to be logged as a plain JSON line, without the prefix of the Lambda logger
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [[dimension]],
+                    'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count')} for name in stats],
+                }],
+            },
+            dimension: value,
+            **{name: round(metric, 3) if isinstance(metric, float) else metric for name, metric in stats.items()},
+        }))
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+
+logger = logging.getLogger()
+
+ACTION_TYPES = ('DEFAULT', 'BYPASS_SPAM_CHECK', 'MOVE_TO_JUNK', 'BOUNCE', 'DROP')
+
+Rule = namedtuple('Rule', ['name', 'header', 'regex', 'action', 'parameters', 'priority'])
+
+def load_rules():
+    """
+    Loads rules from the FILTER_RULES environment variable, a JSON list such as:
+
+        [
+            { "name": "high-score", "header": "X-Spam-Score", "regex": "^([5-9]|\\\\d{2,})", "action": "MOVE_TO_JUNK" },
+            { "name": "dmarc-fail", "header": "Authentication-Results", "regex": "dmarc=fail", "ignoreCase": true,
+              "action": "MOVE_TO_JUNK", "priority": 10 },
+            { "name": "gateway", "header": "Received", "regex": "by gateway\\\\.example\\\\.test", "action": "BYPASS_SPAM_CHECK" }
+        ]
+
+    Only "header" and "regex" are required, "action" defaults to MOVE_TO_JUNK and "priority" to 0. BOUNCE rules can
+    carry WorkMail action "parameters", such as a bounceMessage.
+
+    When FILTER_RULES is not set, messages whose FILTER_HEADER_NAME header matches FILTER_HEADER_REGEX are moved to
+    Junk E-Mail, and messages with any other value of that header bypass the spam check
+
+    Returns
+    -------
+    list
+        A list of Rule
+    Raises
+    ------
+    ValueError:
+        When a rule is invalid, or neither FILTER_RULES nor FILTER_HEADER_NAME and FILTER_HEADER_REGEX are set
+    """
+    rules_json = os.getenv('FILTER_RULES')
+    if not rules_json:
+        header = get_env_var('FILTER_HEADER_NAME')
+        regex = get_env_var('FILTER_HEADER_REGEX')
+        return [
+            Rule('match', header, re.compile(regex), 'MOVE_TO_JUNK', None, 1),
+            Rule('no-match', header, re.compile(''), 'BYPASS_SPAM_CHECK', None, 0),
+        ]
+    return parse_rules(rules_json)
+
+def parse_rules(rules_json):
+    """
+    Parses and compiles a JSON list of rules, in the format of FILTER_RULES
+
+    Raises
+    ------
+    ValueError:
+        When a rule is invalid
+    """
+    rules = []
+    for index, rule in enumerate(json.loads(rules_json)):
+        action = rule.get('action', 'MOVE_TO_JUNK')
+        if not rule.get('header') or rule.get('regex') is None or action not in ACTION_TYPES:
+            raise ValueError(f"Invalid rule:{rule}, expected a header, a regex and an action in {ACTION_TYPES}")
+        try:
+            regex = re.compile(rule['regex'], re.IGNORECASE if rule.get('ignoreCase') else 0)
+        except re.error as e:
+            raise ValueError(f"Invalid regex in rule:{rule}: {e}")
+        rules.append(Rule(rule.get('name', f"rule-{index}"), rule['header'], regex, action, rule.get('parameters'), rule.get('priority', 0)))
+    return rules
+
+class RuleEngine:
+    """
+    Evaluates all rules against all occurrences of their headers in a single pass.
+
+    Rules are ranked by priority, highest first, and then by the order in which they are listed; the best ranked rule
+    that matches any occurrence of its header wins. The rules of a header are joined into one alternation regex, which
+    the regex engine can scan for all rules at once, so a header value that matches none of them, the common case,
+    costs a single search. Only when the alternation matches are the rules searched one by one, in rank order, to find
+    the winner. Rules with groups or global inline flags cannot be joined without changing their meaning, and are
+    always searched one by one.
+    """
+
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: -rule.priority)
+        self.headers = {}
+        for rank, rule in enumerate(self.rules):
+            self.headers.setdefault(rule.header.lower(), []).append(rank)
+        self.combined = {}
+        self.standalone = {}
+        for header, ranks in self.headers.items():
+            # case-sensitive and case-insensitive rules are joined separately, as the flag applies to the whole regex
+            patterns = {0: [], re.IGNORECASE: []}
+            standalone = set()
+            for rank in ranks:
+                regex = self.rules[rank].regex
+                if regex.groups or not self._combinable(regex):
+                    standalone.add(rank)
+                else:
+                    patterns[regex.flags & re.IGNORECASE].append(regex.pattern)
+            self.combined[header] = [re.compile('|'.join(joined), flags) for flags, joined in patterns.items() if joined]
+            self.standalone[header] = standalone
+
+    @staticmethod
+    def _combinable(regex):
+        try:
+            re.compile(f"x|{regex.pattern}")
+            return True
+        except re.error:
+            return False
+
+    def evaluate(self, headers, metrics=None):
+        """
+        Returns the winning Rule for the given message headers, or None when no rule matches. Occurrences of a header
+        with an empty value are skipped, like absent headers.
+
+        Parameters
+        ----------
+        headers: email.message.Message, required
+            The parsed headers of the message, every occurrence of a header is evaluated
+        metrics: RuleMetrics, optional
+            Records the time spent searching each header and rule
+        """
+        best = len(self.rules)
+        for header, ranks in self.headers.items():
+            if ranks[0] >= best:
+                continue
+            for value in headers.get_all(header) or []:
+                # a header without a value matches no rule, so that the message keeps the DEFAULT action
+                if value:
+                    best = self._evaluate_value(header, ranks, value, best, metrics)
+        return self.rules[best] if best < len(self.rules) else None
+
+    def _evaluate_value(self, header, ranks, value, best, metrics):
+        start = time.perf_counter()
+        any_match = any(combined.search(value) for combined in self.combined[header])
+        if metrics and self.combined[header]:
+            metrics.record_prefilter(header, time.perf_counter() - start)
+        for rank in ranks:
+            if rank >= best:
+                break
+            if any_match or rank in self.standalone[header]:
+                rule = self.rules[rank]
+                start = time.perf_counter()
+                match = rule.regex.search(value)
+                if metrics:
+                    metrics.record_evaluation(rule, time.perf_counter() - start)
+                if match:
+                    return rank
+        return best
+
+def get_env_var(name):
+    var = os.getenv(name)
+    if not var:
+        error_msg = f'{name} not set in environment. Please follow https://docs.aws.amazon.com/lambda/latest/dg/env_variables.html to set it.'
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+    return var
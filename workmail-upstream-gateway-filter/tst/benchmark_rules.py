@@ -0,0 +1,57 @@
+"""
+Measures the cost of evaluating a rule set per message, comparing a loop that searches every rule against every
+occurrence of its header with the combined per-header regexes of RuleEngine.
+
+    python tst/benchmark_rules.py
+"""
+import os
+import random
+import re
+import sys
+import time
+from email.parser import BytesHeaderParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import rules  # noqa: E402
+
+MESSAGES = 500
+HEADERS = ('X-Spam-Score', 'Authentication-Results', 'ARC-Authentication-Results', 'Received', 'X-Gateway-Verdict')
+
+def make_rules(count):
+    return [
+        rules.Rule(f"rule-{i}", HEADERS[i % len(HEADERS)], re.compile(f"verdict-{i}\\b|token{i}=(?:fail|softfail)"),
+                   'MOVE_TO_JUNK', None, i % 3)
+        for i in range(count)
+    ]
+
+def make_message(rule_count):
+    lines = [f"X-Spam-Score: {random.randint(0, 9)}", f"X-Gateway-Verdict: verdict-{random.randrange(rule_count * 20)}"]
+    lines.append("Authentication-Results: mx.example.test; spf=pass smtp.mailfrom=example.test; dkim=pass; dmarc=pass")
+    lines.append("ARC-Authentication-Results: i=1; mx.example.test; spf=pass; dkim=pass; dmarc=pass")
+    for hop in range(6):
+        lines.append(f"Received: from relay{hop}.example.test (relay{hop}.example.test [192.0.2.{hop}]) by mx.example.test "
+                     f"with ESMTPS id {random.getrandbits(64):x}; Mon, 19 Oct 2026 10:00:0{hop} +0000")
+    lines += ["From: sender@example.test", "To: recipient@example.test", "Subject: Benchmark", "", "Body"]
+    return BytesHeaderParser().parsebytes('\r\n'.join(lines).encode())
+
+def naive_evaluate(rule_list, headers):
+    best = None
+    for rule in rule_list:
+        if best and rule.priority <= best.priority:
+            continue
+        if any(rule.regex.search(value) for value in headers.get_all(rule.header) or []):
+            best = rule
+    return best
+
+random.seed(1)
+for rule_count in (1, 10, 50, 200):
+    rule_list = make_rules(rule_count)
+    engine = rules.RuleEngine(rule_list)
+    messages = [make_message(rule_count) for _ in range(MESSAGES)]
+    for name, evaluate in (('rule by rule', lambda headers: naive_evaluate(rule_list, headers)), ('combined', engine.evaluate)):
+        start = time.perf_counter()
+        matches = sum(1 for headers in messages if evaluate(headers))
+        elapsed = (time.perf_counter() - start) / MESSAGES
+        print(f"{rule_count:4} rules, {name:12}: {elapsed * 1e6:8.1f} us/message, "
+              f"{elapsed * 1e6 / rule_count:6.2f} us/rule, {matches} matches")
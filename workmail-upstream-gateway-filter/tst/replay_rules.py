@@ -0,0 +1,95 @@
+"""
+Replays a corpus of message headers against a rule file, in the format of FILTER_RULES, and reports for every rule
+how often it matched and how long searching its header took. Rules whose worst-case search time exceeds the budget
+are flagged, which catches slow and catastrophically backtracking regular expressions before they are deployed.
+
+The corpus consists of .eml files, mbox files or directories containing them. Every rule is searched against every
+occurrence of its header in every message, whether or not a better ranked rule already matched, so that the worst
+case is found.
+
+    python tst/replay_rules.py rules.json corpus/ --budget-ms 1
+"""
+import argparse
+import mailbox
+import os
+import statistics
+import sys
+import time
+from email.parser import BytesHeaderParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import rules  # noqa: E402
+
+def read_corpus(paths):
+    """
+    Yields the parsed headers of every message in the given .eml files, mbox files and directories
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from read_corpus(sorted(os.path.join(path, name) for name in os.listdir(path)))
+            continue
+        with open(path, 'rb') as f:
+            is_mbox = f.read(5) == b'From '
+        if is_mbox:
+            yield from mailbox.mbox(path)
+        else:
+            with open(path, 'rb') as f:
+                yield BytesHeaderParser().parse(f)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rules', help='JSON file with a list of rules')
+    parser.add_argument('corpus', nargs='+', help='.eml files, mbox files or directories')
+    parser.add_argument('--budget-ms', type=float, default=1.0, help='worst-case search time allowed per header occurrence')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times every search is timed, the fastest is kept')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    with open(args.rules) as f:
+        rule_list = rules.parse_rules(f.read())
+    engine = rules.RuleEngine(rule_list)
+
+    times = {rule.name: [] for rule in rule_list}
+    matches = {rule.name: 0 for rule in rule_list}
+    decisions = {rule.name: 0 for rule in rule_list}
+    messages = 0
+    for headers in read_corpus(args.corpus):
+        messages += 1
+        for rule in rule_list:
+            matched = False
+            for value in headers.get_all(rule.header) or []:
+                # the fastest of several runs filters out noise, a catastrophic case is slow on every run
+                elapsed = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    match = rule.regex.search(value)
+                    elapsed.append(time.perf_counter() - start)
+                times[rule.name].append(min(elapsed) * 1000)
+                matched = matched or match is not None
+            matches[rule.name] += matched
+        winner = engine.evaluate(headers)
+        if winner:
+            decisions[winner.name] += 1
+
+    print(f"{messages} messages, {len(rule_list)} rules, budget {args.budget_ms} ms")
+    print(f"{'rule':24} {'header':28} {'searches':>8} {'matched':>8} {'decided':>8} {'mean ms':>9} {'max ms':>9}")
+    over_budget = []
+    for rule in sorted(rule_list, key=lambda rule: -max(times[rule.name], default=0)):
+        rule_times = times[rule.name]
+        worst = max(rule_times, default=0)
+        flag = ''
+        if worst > args.budget_ms:
+            over_budget.append(rule.name)
+            flag = '  OVER BUDGET'
+        mean = statistics.mean(rule_times) if rule_times else 0
+        print(f"{rule.name[:24]:24} {rule.header[:28]:28} {len(rule_times):8} {matches[rule.name]:8} "
+              f"{decisions[rule.name]:8} {mean:9.4f} {worst:9.4f}{flag}")
+
+    if over_budget:
+        print(f"{len(over_budget)} rules over budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Tests of the rule engine, run with:
+
+    python -m unittest discover -s tst
+"""
+import os
+import sys
+import unittest
+from email.parser import HeaderParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import rules  # noqa: E402
+
+def headers(text):
+    return HeaderParser().parsestr(text)
+
+class DefaultRulesTest(unittest.TestCase):
+    """
+    The rules built from FILTER_HEADER_NAME and FILTER_HEADER_REGEX when FILTER_RULES is not set
+    """
+
+    def setUp(self):
+        os.environ.pop('FILTER_RULES', None)
+        os.environ['FILTER_HEADER_NAME'] = 'X-Upstream-Spam'
+        os.environ['FILTER_HEADER_REGEX'] = 'yes'
+        self.engine = rules.RuleEngine(rules.load_rules())
+
+    def action(self, text):
+        rule = self.engine.evaluate(headers(text))
+        return rule.action if rule else 'DEFAULT'
+
+    def test_matching_value_moves_to_junk(self):
+        self.assertEqual(self.action('X-Upstream-Spam: yes\n\n'), 'MOVE_TO_JUNK')
+
+    def test_other_value_bypasses_spam_check(self):
+        self.assertEqual(self.action('X-Upstream-Spam: no\n\n'), 'BYPASS_SPAM_CHECK')
+
+    def test_empty_value_keeps_default(self):
+        self.assertEqual(self.action('X-Upstream-Spam:\n\n'), 'DEFAULT')
+        self.assertEqual(self.action('X-Upstream-Spam: \n\n'), 'DEFAULT')
+
+    def test_missing_header_keeps_default(self):
+        self.assertEqual(self.action('Subject: hello\n\n'), 'DEFAULT')
+
+    def test_empty_occurrence_does_not_hide_others(self):
+        self.assertEqual(self.action('X-Upstream-Spam:\nX-Upstream-Spam: yes\n\n'), 'MOVE_TO_JUNK')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import logging
 import os
+import time
 import urllib.parse
 import requests
+import media
 import utils
 
 logger = logging.getLogger()
@@ -9,11 +11,23 @@ logger.setLevel(logging.INFO)
 
 API_BASE_ENDPOINT = "https://public-api.wordpress.com/rest/v1.2/sites/"
 CREATE_POST_SUFFIX = "/posts/new"
+UPLOAD_MEDIA_SUFFIX = "/media/new"
 
 # A string which triggers posting to the blog. The email subject must start with this string in order
 # for the email to converted to a blog submission
 TRIGGER = "[Blog Submission]"
 
+# Images of the email are uploaded by up to MEDIA_UPLOAD_WORKERS threads at once. With MAX_IMAGE_DIMENSION, larger
+# images are downscaled to that many pixels of width and height before being uploaded
+MEDIA_UPLOAD_WORKERS = int(os.getenv('MEDIA_UPLOAD_WORKERS', 4))
+MAX_IMAGE_DIMENSION = int(os.getenv('MAX_IMAGE_DIMENSION', 0))
+
+# Time kept free at the end of an invocation to create the post after the images are uploaded
+CREATE_POST_MARGIN_MS = 3000
+
+# Shared by all invocations in this Lambda container, so that connections to WordPress are reused
+session = media.create_session(MEDIA_UPLOAD_WORKERS)
+
 def post_handler(event, context):
     """
     Automated Blog Poster for Amazon WorkMail
@@ -105,6 +119,15 @@ def post_handler(event, context):
     downloaded_email = utils.download_email(event['messageId'])
     email_body = utils.extract_email_body(downloaded_email)
 
+    images = media.find_image_parts(downloaded_email)
+    if images:
+        logger.info(f"Uploading {len(images)} images")
+        uploader = media.MediaUploader(session, API_BASE_ENDPOINT + site + UPLOAD_MEDIA_SUFFIX, api_token,
+                                       max_workers=MEDIA_UPLOAD_WORKERS, max_dimension=MAX_IMAGE_DIMENSION)
+        deadline = time.monotonic() + max(context.get_remaining_time_in_millis() - CREATE_POST_MARGIN_MS, 1000) / 1000
+        uploaded = uploader.upload_all(images, deadline)
+        email_body = media.embed_images(email_body or '', uploaded)
+
     post_body = f"Author: {post_author}\n\n{email_body}"
 
     headers = {
@@ -120,7 +143,7 @@ def post_handler(event, context):
 
     try:
         logger.info(f"Creating post from author '{post_author}' with title '{post_title}'")
-        response = requests.post(create_post_endpoint, headers=headers, data=encoded_params)
+        response = session.post(create_post_endpoint, headers=headers, data=encoded_params)
         response.raise_for_status()
         logger.info("Succesfully submitted draft post")
     except requests.exceptions.HTTPError as error:
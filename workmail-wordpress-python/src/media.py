@@ -0,0 +1,244 @@
+import binascii
+import html
+import logging
+import mimetypes
+import re
+import tempfile
+import time
+import urllib.parse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageOps
+
+logger = logging.getLogger()
+
+# Decoded images larger than this are spooled to /tmp instead of being kept in memory
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+# Base64 payloads are decoded in chunks of this many characters
+DECODE_CHUNK_SIZE = 1024 * 1024
+# Quality of downscaled JPEG and WebP images
+IMAGE_QUALITY = 85
+# Upper bound of the time to connect to the media endpoint, clamped to the time left until the deadline
+CONNECT_TIMEOUT_SECONDS = 3
+
+ImagePart = namedtuple('ImagePart', ['content_id', 'filename', 'content_type', 'part'])
+
+CID_REFERENCE = re.compile(r'cid:([^"\'\s>)]+)', re.IGNORECASE)
+
+def create_session(pool_maxsize):
+    """
+    Returns a requests Session whose connection pool can keep pool_maxsize connections open per host, so that
+    concurrent uploads and later invocations in the same Lambda container reuse connections
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def find_image_parts(parsed_email):
+    """
+    Finds the inline images and image attachments of a parsed email
+
+    Parameters
+    ----------
+    parsed_email: email.message.Message, required
+        The parsed email as returned by download_email
+    Returns
+    -------
+    list
+        A list of ImagePart, with the Content-ID of every image without its angle brackets, or None
+    """
+    images = []
+    for index, part in enumerate(parsed_email.walk()):
+        if part.get_content_maintype() != 'image':
+            continue
+        content_type = part.get_content_type()
+        content_id = part.get('Content-ID', '').strip().strip('<>') or None
+        filename = part.get_filename() or f"image-{index}{mimetypes.guess_extension(content_type) or ''}"
+        images.append(ImagePart(content_id, filename, content_type, part))
+    return images
+
+def open_payload(part):
+    """
+    Decodes the payload of a message part into a temporary file, which stays in memory up to SPOOL_MAX_SIZE bytes.
+    Base64 payloads are decoded chunk by chunk, so that the whole decoded image is never held in memory as well.
+
+    Returns
+    -------
+    tempfile.SpooledTemporaryFile
+        The decoded payload, positioned at its start
+    """
+    stream = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if part.get('Content-Transfer-Encoding', '').strip().lower() == 'base64':
+        payload = part.get_payload()
+        leftover = ''
+        for start in range(0, len(payload), DECODE_CHUNK_SIZE):
+            chunk = leftover + ''.join(payload[start:start + DECODE_CHUNK_SIZE].split())
+            # only decode whole groups of 4 characters, the rest is decoded with the next chunk
+            end = len(chunk) - len(chunk) % 4
+            stream.write(binascii.a2b_base64(chunk[:end]))
+            leftover = chunk[end:]
+        if leftover:
+            stream.write(binascii.a2b_base64(leftover + '=' * (-len(leftover) % 4)))
+    else:
+        stream.write(part.get_payload(decode=True) or b'')
+    stream.seek(0)
+    return stream
+
+def downscale(stream, max_dimension):
+    """
+    Downscales an image so that neither its width nor its height exceed max_dimension, and recompresses it in its
+    original format. JPEG images are decoded at a reduced size to begin with, which saves most of the decoding time
+    and memory of large photos. The EXIF orientation is applied to the pixels, as it is not kept in the recompressed
+    image, so that photos taken in portrait keep their orientation.
+
+    Parameters
+    ----------
+    stream: file object, required
+        The image
+    max_dimension: int, required
+        The maximum width and height in pixels
+    Returns
+    -------
+    file object
+        The downscaled image, or stream itself when the image is small enough or its format cannot be written
+    """
+    try:
+        image = Image.open(stream)
+    except Image.UnidentifiedImageError:
+        stream.seek(0)
+        return stream
+    image_format = image.format
+    if max(image.size) <= max_dimension or image_format not in ('JPEG', 'PNG', 'WEBP'):
+        stream.seek(0)
+        return stream
+
+    image.draft('RGB', (max_dimension, max_dimension))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_dimension, max_dimension))
+    downscaled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if image_format == 'PNG':
+        image.save(downscaled, image_format, optimize=True)
+    else:
+        image.save(downscaled, image_format, quality=IMAGE_QUALITY)
+    stream.close()
+    downscaled.seek(0)
+    return downscaled
+
+class MediaUploader:
+    """
+    Uploads the images of an email to the media library of a WordPress.com site concurrently, over a pooled session.
+    Every image is decoded, and downscaled when max_dimension is set, by the thread that uploads it, so that one image
+    is prepared while others are being uploaded.
+    """
+
+    def __init__(self, session, media_endpoint, api_token, max_workers=4, max_dimension=0):
+        self.session = session
+        self.media_endpoint = media_endpoint
+        self.api_token = api_token
+        self.max_workers = max_workers
+        self.max_dimension = max_dimension
+
+    def upload_all(self, images, deadline):
+        """
+        Uploads images and returns the URLs of the uploaded ones. Images that fail to upload, or whose upload does
+        not finish by deadline, are logged and skipped. The read timeout of requests bounds every read from the socket
+        rather than the whole upload, so uploads still running at deadline are abandoned instead of waited for.
+
+        Parameters
+        ----------
+        images: list, required
+            A list of ImagePart
+        deadline: float, required
+            time.monotonic() value by which all uploads have to be done, every upload gets the time left until then
+        Returns
+        -------
+        list
+            (ImagePart, URL) tuples for the uploaded images, in the order of images
+        """
+        if not images:
+            return []
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(images)))
+        futures = [executor.submit(self.upload, image, deadline) for image in images]
+        done, _ = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        executor.shutdown(wait=False, cancel_futures=True)
+        uploaded = []
+        for image, future in zip(images, futures):
+            if future not in done:
+                logger.error(f"Upload of image {image.filename} did not finish before the deadline")
+            elif future.exception():
+                logger.error(f"Error while uploading image {image.filename}: {future.exception()}")
+            else:
+                uploaded.append((image, future.result()))
+        return uploaded
+
+    def upload(self, image, deadline):
+        """
+        Uploads one image and returns its URL
+
+        Raises
+        ------
+        requests.exceptions.RequestException:
+            When the upload fails
+        TimeoutError:
+            When the deadline has passed before the upload starts
+        ValueError:
+            When WordPress does not return the uploaded image
+        """
+        if time.monotonic() >= deadline:
+            raise TimeoutError("No time left to upload the image")
+        stream = open_payload(image.part)
+        try:
+            if self.max_dimension:
+                stream = downscale(stream, self.max_dimension)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No time left to upload the image")
+            response = self.session.post(
+                self.media_endpoint,
+                headers={'Authorization': 'Bearer ' + self.api_token},
+                files={'media[]': (image.filename, stream, image.content_type)},
+                timeout=(min(CONNECT_TIMEOUT_SECONDS, remaining), remaining),
+            )
+        finally:
+            stream.close()
+        response.raise_for_status()
+        media = response.json().get('media')
+        if not media:
+            raise ValueError(f"No media in response: {response.text}")
+        return media[0]['URL']
+
+def embed_images(body, uploaded):
+    """
+    Replaces the cid: references to uploaded images in body with their URLs, and appends the uploaded images that
+    body does not reference, such as attachments
+
+    Parameters
+    ----------
+    body: string, required
+        The email body
+    uploaded: list, required
+        (ImagePart, URL) tuples as returned by MediaUploader.upload_all
+    Returns
+    -------
+    string
+        body with the images embedded
+    """
+    urls_by_content_id = {image.content_id: url for image, url in uploaded if image.content_id}
+    referenced = set()
+
+    def replace(match):
+        content_id = urllib.parse.unquote(match.group(1))
+        if content_id not in urls_by_content_id:
+            return match.group(0)
+        referenced.add(content_id)
+        return urls_by_content_id[content_id]
+
+    body = CID_REFERENCE.sub(replace, body)
+    for image, url in uploaded:
+        if image.content_id not in referenced:
+            body += f'\n<img src="{html.escape(url)}" alt="{html.escape(image.filename)}" />'
+    return body
@@ -0,0 +1,89 @@
+"""
+Measures how long uploading the images of a blog submission takes, one at a time and concurrently, with and without
+downscaling, against a local HTTP stand-in for the WordPress media endpoint. The stand-in takes PROCESSING_SECONDS per
+upload plus the time the upload would take at UPLOAD_BYTES_PER_SECOND.
+
+    python tst/benchmark_media.py
+"""
+import email
+import io
+import json
+import os
+import sys
+import threading
+import time
+from email.message import EmailMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import media  # noqa: E402
+import utils  # noqa: E402
+
+PROCESSING_SECONDS = 0.2
+UPLOAD_BYTES_PER_SECOND = 10 * 1024 * 1024
+# a photo from a phone camera
+IMAGE_SIZE = (4032, 3024)
+
+class MediaStandIn(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    uploaded_bytes = 0
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        MediaStandIn.uploaded_bytes += length
+        time.sleep(PROCESSING_SECONDS + length / UPLOAD_BYTES_PER_SECOND)
+        body = json.dumps({'media': [{'ID': 1, 'URL': f"https://blog.example.test/uploads/{time.monotonic_ns()}.jpg"}]})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+def photo(seed):
+    image = Image.effect_noise((IMAGE_SIZE[0] // 8, IMAGE_SIZE[1] // 8), 40 + seed).convert('RGB')
+    buffer = io.BytesIO()
+    image.resize(IMAGE_SIZE, Image.BILINEAR).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+def submission(photos):
+    message = EmailMessage()
+    message['Subject'] = '[Blog Submission] Holiday photos'
+    message.set_content('Holiday photos')
+    message.add_alternative(''.join(f'<p><img src="cid:photo{i}@example.test"></p>' for i in range(len(photos))), subtype='html')
+    html_part = message.get_payload()[1]
+    for i, data in enumerate(photos):
+        html_part.add_related(data, 'image', 'jpeg', cid=f"<photo{i}@example.test>", filename=f"photo{i}.jpg")
+    return email.message_from_bytes(message.as_bytes())
+
+def run(endpoint, parsed_email, workers, max_dimension):
+    images = media.find_image_parts(parsed_email)
+    uploader = media.MediaUploader(media.create_session(workers), endpoint, 'token', workers, max_dimension)
+    MediaStandIn.uploaded_bytes = 0
+    start = time.perf_counter()
+    uploaded = uploader.upload_all(images, deadline=time.monotonic() + 30)
+    elapsed = time.perf_counter() - start
+    body = media.embed_images(utils.extract_email_body(parsed_email), uploaded)
+    assert len(uploaded) == len(images) and 'cid:' not in body
+    print(f"{len(images)} images, {workers} workers, max dimension {max_dimension or '-':>4}: "
+          f"{elapsed * 1000:7.0f} ms, {MediaStandIn.uploaded_bytes / 1024 / 1024:5.1f} MiB uploaded")
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), MediaStandIn)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+endpoint = f"http://127.0.0.1:{server.server_port}/media/new"
+
+photos = [photo(i) for i in range(8)]
+for count in (1, 4, 8):
+    parsed_email = submission(photos[:count])
+    for max_dimension in (0, 2048):
+        for workers in (1, 4, 8):
+            if workers <= count or workers == 1:
+                run(endpoint, parsed_email, workers, max_dimension)
+server.shutdown()